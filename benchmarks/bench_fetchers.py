@@ -0,0 +1,180 @@
+#     CT SDE EdSight Data Scraping Command Line Interface.
+#     Copyright (C) 2017  Sasha Cuerda, Connecticut Data Collaborative
+#
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Measure each fetch mode end to end against the local stub server, without touching edsight.ct.gov.
+
+The stub serves synthetic csvs sized from the bundled catalog and can inject latency, HTML error
+pages, "No Search Results" bodies and connection resets. Every mode runs in its own process, so
+its peak RSS is its own. Reports requests per second, p95 latency and peak RSS per mode. Run from
+the repository root:
+
+    python -m benchmarks.bench_fetchers --targets 2000 --latency 0.02 --error-rate 0.01 --reset-rate 0.005
+"""
+
+import argparse
+import asyncio
+import io
+import itertools
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+MODES = ('sync', 'threaded', 'async')
+
+
+def _catalog(origin=None):
+    """The bundled catalog, with its export links pointed at `origin` when given."""
+    from ctdata_edsight_scraping_tool.catalog import CATALOG_PATH, load_catalog
+    catalog = load_catalog(CATALOG_PATH)
+    if origin:
+        for dataset in catalog.values():
+            dataset['download_link'] = dataset['download_link'].replace('http://edsight.ct.gov', origin)
+    return catalog
+
+
+def _targets(catalog, output_dir, n_targets):
+    """The first `n_targets` targets of a catalog run into `output_dir`."""
+    from ctdata_edsight_scraping_tool.helpers import (_build_catalog_geo_list, _iter_download_targets,
+                                                      _setup_catalog_targets, custom_slugify)
+    jobs = []
+    for d in _build_catalog_geo_list(catalog):
+        for g in d['geos']:
+            try:
+                next(_iter_download_targets(d['dataset'], output_dir, g, catalog), None)
+            except KeyError:
+                # Datasets whose catalog entry cannot be planned are left out
+                continue
+            target_dir = os.path.join(output_dir, custom_slugify("{} {}".format(d['dataset'], g)))
+            os.makedirs(target_dir, exist_ok=True)
+            jobs.append((d['dataset'], target_dir, g))
+    return itertools.islice(_setup_catalog_targets(jobs, catalog), n_targets)
+
+
+def _peak_rss_mb():
+    """Peak resident memory of this process.
+
+    ru_maxrss survives fork and exec on Linux, so a child would report the parent's peak if it was
+    higher; VmHWM belongs to this process's own address space.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # Kilobytes on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+def run_mode(mode, origin, n_targets, threads):
+    """Fetch `n_targets` catalog targets from the stub at `origin` in one mode and measure it."""
+    from ctdata_edsight_scraping_tool.metrics import RunMetrics
+    from ctdata_edsight_scraping_tool.progress import Progress
+    from ctdata_edsight_scraping_tool.retry import RetryPolicy
+    base_url = origin + '/SASPortal/main.do'
+    metrics = RunMetrics()
+    # Short backoff, so injected faults cost retries rather than idle time
+    options = dict(retry_policy=RetryPolicy(base_delay=.01, max_delay=.1), metrics=metrics,
+                   progress=Progress(mode='quiet', stream=io.StringIO()).start())
+    with tempfile.TemporaryDirectory() as tmp:
+        targets = _targets(_catalog(origin), tmp, n_targets)
+        start = time.perf_counter()
+        if mode == 'async':
+            from ctdata_edsight_scraping_tool.fetch_async import fetch_targets
+            asyncio.get_event_loop().run_until_complete(fetch_targets(targets, base_url=base_url, **options))
+        elif mode == 'threaded':
+            from ctdata_edsight_scraping_tool.fetch_sync import fetch_targets_threaded
+            fetch_targets_threaded(targets, base_url=base_url, threads=threads, **options)
+        else:
+            from ctdata_edsight_scraping_tool.fetch_sync import fetch_targets_sync
+            fetch_targets_sync(targets, base_url=base_url, **options)
+        elapsed = time.perf_counter() - start
+    report = metrics.report()
+    outcomes = {}
+    for dataset in report['datasets'].values():
+        for outcome, n in dataset['outcomes'].items():
+            outcomes[outcome] = outcomes.get(outcome, 0) + n
+    return {
+        'mode': mode,
+        'seconds': elapsed,
+        'targets': report['requests'],
+        'requests_per_second': report['requests'] / elapsed,
+        'p95': report['latency']['p95'],
+        'bytes': report['bytes'],
+        'outcomes': outcomes,
+        'peak_rss_mb': _peak_rss_mb(),
+    }
+
+
+def _start_server(options):
+    from .stub_server import StubServer
+    loop = asyncio.new_event_loop()
+    server = StubServer(catalog=_catalog(), **options)
+    started = threading.Event()
+
+    def serve():
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(server.start())
+        started.set()
+        loop.run_forever()
+    threading.Thread(target=serve, daemon=True).start()
+    started.wait()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--targets', type=int, default=1000)
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=list(MODES))
+    parser.add_argument('--threads', type=int, default=10)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help="Seconds of artificial server latency per export.")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Chance of an HTML error page.")
+    parser.add_argument('--no-results-rate', type=float, default=0.0, help="Chance of a No Search Results body.")
+    parser.add_argument('--reset-rate', type=float, default=0.0, help="Chance of a connection reset.")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--child', choices=MODES, help=argparse.SUPPRESS)
+    parser.add_argument('--origin', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_mode(args.child, args.origin, args.targets, args.threads)))
+        return
+
+    server = _start_server(dict(latency=args.latency, error_rate=args.error_rate,
+                                no_results_rate=args.no_results_rate, reset_rate=args.reset_rate, seed=args.seed))
+    print("{:<10} {:>8} {:>9} {:>9} {:>10} {:>9} {:>8} {:>8} {:>8}".format(
+        'mode', 'targets', 'seconds', 'req/s', 'p95 (ms)', 'rss (MB)', 'requests', 'faults', 'failed'))
+    for mode in args.modes:
+        server.reset()
+        cmd = [sys.executable, '-m', 'benchmarks.bench_fetchers', '--child', mode, '--origin', server.origin,
+               '--targets', str(args.targets), '--threads', str(args.threads)]
+        result = json.loads(subprocess.check_output(cmd).decode().splitlines()[-1])
+        failed = result['outcomes'].get('bad_response', 0) + result['outcomes'].get('network_error', 0)
+        print("{:<10} {:>8} {:>9.2f} {:>9.1f} {:>10.1f} {:>9.1f} {:>8} {:>8} {:>8}".format(
+            mode, result['targets'], result['seconds'], result['requests_per_second'], (result['p95'] or 0) * 1000,
+            result['peak_rss_mb'], server.requests - server.primes, sum(server.faults.values()), failed))
+
+
+if __name__ == '__main__':
+    main()
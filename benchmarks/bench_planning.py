@@ -0,0 +1,186 @@
+#     CT SDE EdSight Data Scraping Command Line Interface.
+#     Copyright (C) 2017  Sasha Cuerda, Connecticut Data Collaborative
+#
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Time and trace the allocations of each download target planning stage over the real catalog.
+
+Every dataset and geography in catalog/datasets.json is planned stage by stage: the params product
+(_build_params_list), the state-level copies (_add_ct), slugging filenames (custom_slugify), the
+targets themselves (_build_url_list) and, end to end, _setup_download_targets. The catalog can be
+inflated with synthetic options for the Year and subgroup filters to see how planning scales as
+EdSight adds years and filters. Run from the repository root:
+
+    python -m benchmarks.bench_planning --factors 1 10
+    python -m benchmarks.bench_planning --factors 1 2 4 --inflate Year --list-scan
+
+Times are the best of --repeat runs. Allocations are traced in a separate run, because tracemalloc
+slows everything it watches: "peak" is the most memory a stage held at once while planning any one
+dataset and geography, and "retained" is what the results of all of them hold afterwards.
+"""
+
+import argparse
+import copy
+import json
+import os
+import time
+import tracemalloc
+from urllib.parse import urlparse, parse_qs
+
+from ctdata_edsight_scraping_tool import helpers
+
+CATALOG_PATH = os.path.join(os.path.dirname(helpers.__file__), 'catalog', 'datasets.json')
+
+SUBGROUP_FILTERS = ('Subgroup', 'Filter By', 'Race/Ethnicity', 'Disability')
+STAGES = ('_build_params_list', '_add_ct', 'custom_slugify', '_build_url_list', '_setup_download_targets')
+LIST_SCAN = '_add_ct (list scan)'
+MiB = 1024 * 1024
+
+
+def _list_scan_add_ct(param_list):
+    """The previous _add_ct, which checked every new row against a plain list."""
+    ct_list = []
+    for p in param_list:
+        new = {**p}
+        new['_district'] = 'State of Connecticut'
+        if '_school' in new:
+            new.__delitem__('_school')
+        if new not in ct_list:
+            ct_list.append(new)
+    return param_list + list(ct_list)
+
+
+def inflate(dataset, factor, names=('Year',) + SUBGROUP_FILTERS):
+    """Copy of `dataset` with `factor` times as many options for each filter in `names`."""
+    ds = copy.deepcopy(dataset)
+    for f in ds['filters']:
+        if f['name'] in names:
+            f['options'] = f['options'] + ['{} #{}'.format(o, i) for i in range(1, factor) for o in f['options']]
+    return ds
+
+
+def _filenames(dataset_name, params, xpaths):
+    """The unslugged filenames _iter_url_list builds, so that custom_slugify can be timed on its own."""
+    names = []
+    for p in params:
+        f = [p.get(v, '') for v in xpaths]
+        if p['_district'] == 'State of Connecticut':
+            f.append('ct')
+        names.append("{}__{}".format(dataset_name, '_'.join(f)))
+    return names
+
+
+def measure(fn, repeat=1):
+    """Run `fn` and return (result, best seconds, peak bytes, retained bytes)."""
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        seconds.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        result = fn()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, min(seconds), peak - before, current - before
+
+
+def plan_stages(name, ds, geography, output_dir, repeat=1, list_scan=False):
+    """Measure every planning stage for one dataset and geography, each fed by the stage before it.
+
+    Returns ({stage: (seconds, peak, retained)}, number of targets).
+    """
+    exclude = ['District', 'School'] if geography == 'District' else ['District']
+    variables = [f['name'] for f in ds['filters'] if f['name'] not in exclude]
+    parsed = urlparse(ds['download_link'])
+    qs = parse_qs(parsed.query)
+    url = parsed._replace(query=None).geturl()
+    xpaths = helpers._get_xpaths(ds['filters'], variables)
+
+    stages = {}
+    params, *stages['_build_params_list'] = measure(lambda: helpers._build_params_list(ds, qs, variables), repeat)
+    if name != 'Enrollment':
+        if list_scan:
+            _, *stages[LIST_SCAN] = measure(lambda: _list_scan_add_ct(params), repeat)
+        params, *stages['_add_ct'] = measure(lambda: helpers._add_ct(params), repeat)
+    else:
+        stages['_add_ct'] = [0.0, 0, 0]
+    names = _filenames(name, params, xpaths)
+    _, *stages['custom_slugify'] = measure(lambda: [helpers.custom_slugify(n) for n in names], repeat)
+    targets, *stages['_build_url_list'] = measure(
+        lambda: helpers._build_url_list(params, xpaths, url, output_dir, name), repeat)
+    _, *stages['_setup_download_targets'] = measure(
+        lambda: helpers._setup_download_targets(name, output_dir, geography, {name: ds}), repeat)
+    return stages, len(targets)
+
+
+def bench(catalog, factor, names=('Year',) + SUBGROUP_FILTERS, repeat=1, list_scan=False, output_dir='/tmp'):
+    totals = {'factor': factor, 'plans': 0, 'targets': 0, 'skipped': [],
+              'stages': {s: [0.0, 0, 0] for s in STAGES + ((LIST_SCAN,) if list_scan else ())}}
+    for entry in helpers._build_catalog_geo_list(catalog):
+        name = entry['dataset']
+        ds = inflate(catalog[name], factor, names)
+        for geo in entry['geos']:
+            try:
+                stages, targets = plan_stages(name, ds, geo, output_dir, repeat, list_scan)
+            except KeyError:
+                # Datasets without a District filter cannot be planned yet
+                totals['skipped'].append('{} ({})'.format(name, geo))
+                continue
+            totals['plans'] += 1
+            totals['targets'] += targets
+            for stage, (seconds, peak, retained) in stages.items():
+                t = totals['stages'][stage]
+                # Stages run one plan at a time, so the largest single peak is the one that matters
+                t[0] += seconds
+                t[1] = max(t[1], peak)
+                t[2] += retained
+    return totals
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--factors', type=int, nargs='+', default=[1, 10])
+    parser.add_argument('--inflate', nargs='+', default=('Year',) + SUBGROUP_FILTERS, metavar='FILTER',
+                        help='filters whose options are multiplied by each factor')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--list-scan', action='store_true',
+                        help='also time the previous, quadratic _add_ct')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    with open(CATALOG_PATH) as f:
+        catalog = json.load(f)
+    results = []
+    for factor in args.factors:
+        t = bench(catalog, factor, args.inflate, args.repeat, args.list_scan)
+        results.append(t)
+        print("factor {}: {} datasets, {} plans, {} targets{}".format(
+            factor, len(catalog), t['plans'], t['targets'],
+            '; skipped ' + ', '.join(t['skipped']) if t['skipped'] else ''))
+        print("  {:<26} {:>10} {:>12} {:>12} {:>14}".format(
+            'stage', 'seconds', 'us/target', 'peak (MiB)', 'retained (MiB)'))
+        for stage, (seconds, peak, retained) in t['stages'].items():
+            print("  {:<26} {:>10.3f} {:>12.2f} {:>12.1f} {:>14.1f}".format(
+                stage, seconds, seconds / max(t['targets'], 1) * 1e6, peak / MiB, retained / MiB))
+        print()
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+#     CT SDE EdSight Data Scraping Command Line Interface.
+#     Copyright (C) 2017  Sasha Cuerda, Connecticut Data Collaborative
+#
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Compare a fresh, freshly primed ClientSession per target against the shared, pooled session.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_session_pool --targets 1000
+"""
+
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+import aiohttp
+
+from ctdata_edsight_scraping_tool import fetch_async
+from .stub_server import StubServer
+
+
+async def _per_target_sessions(targets, base_url):
+    """The old behaviour: every target opens (and tears down) its own session and primes it."""
+    sema = asyncio.BoundedSemaphore(fetch_async.CONCURRENCY)
+
+    async def one(t):
+        async with sema:
+            async with aiohttp.ClientSession(headers=fetch_async.HEADERS) as session:
+                async with session.get(base_url):
+                    pass
+                async with session.get(t['url'], params=t['param']) as resp:
+                    await resp.text()
+    await asyncio.gather(*(one(t) for t in targets))
+
+
+async def _run(n_targets, latency):
+    server = await StubServer(latency=latency).start()
+    with tempfile.TemporaryDirectory() as tmp:
+        targets = [{'url': server.export_url,
+                    'param': {'_year': str(i)},
+                    'filename': os.path.join(tmp, '{}.csv'.format(i))} for i in range(n_targets)]
+        results = []
+        for label, run in (('session per target', _per_target_sessions(targets, server.base_url)),
+                           ('pooled session', fetch_async.fetch_targets(targets, save=False,
+                                                                        base_url=server.base_url))):
+            server.reset()
+            start = time.perf_counter()
+            await run
+            elapsed = time.perf_counter() - start
+            results.append((label, elapsed, server.requests, server.primes, len(server.connections)))
+    await server.stop()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--targets', type=int, default=500)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help="Seconds of artificial server latency per export.")
+    args = parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+    results = loop.run_until_complete(_run(args.targets, args.latency))
+    print("{:<20} {:>10} {:>10} {:>8} {:>12} {:>10}".format(
+        'mode', 'seconds', 'requests', 'primes', 'connections', 'req/s'))
+    for label, elapsed, requests, primes, connections in results:
+        print("{:<20} {:>10.2f} {:>10} {:>8} {:>12} {:>10.1f}".format(
+            label, elapsed, requests, primes, connections, requests / elapsed))
+
+
+if __name__ == '__main__':
+    main()
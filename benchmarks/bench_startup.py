@@ -0,0 +1,90 @@
+#     CT SDE EdSight Data Scraping Command Line Interface.
+#     Copyright (C) 2017  Sasha Cuerda, Connecticut Data Collaborative
+#
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Time how long short CLI invocations take from process start to exit.
+
+Each command is run repeatedly in a fresh interpreter. With --history, one row per command is
+appended to a csv file, so startup time can be tracked from commit to commit. Run from the
+repository root:
+
+    python -m benchmarks.bench_startup --runs 20 --history benchmarks/startup_history.csv
+"""
+
+import argparse
+import csv
+import datetime
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+COMMANDS = [
+    ('--help', ['--help']),
+    ('datasets', ['datasets']),
+    ('info', ['info', '-d', 'Chronic Absenteeism']),
+]
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def time_command(args, runs):
+    timings = []
+    cmd = [sys.executable, '-m', 'ctdata_edsight_scraping_tool.cli'] + args
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--history', help="Append results to this csv file.")
+    args = parser.parse_args()
+
+    # One warm-up run builds the precompiled catalog so every timed run measures the steady state
+    time_command(['datasets'], 1)
+    rows = []
+    print("{:<10} {:>10} {:>10} {:>10}".format('command', 'min (ms)', 'median (ms)', 'max (ms)'))
+    for label, cmd in COMMANDS:
+        timings = time_command(cmd, args.runs)
+        row = [label, min(timings) * 1000, statistics.median(timings) * 1000, max(timings) * 1000]
+        rows.append(row)
+        print("{:<10} {:>10.1f} {:>10.1f} {:>10.1f}".format(*row))
+
+    if args.history:
+        new_file = not os.path.exists(args.history)
+        stamp = datetime.datetime.now().isoformat(timespec='seconds')
+        revision = _git_revision()
+        with open(args.history, 'a', newline='') as f:
+            writer = csv.writer(f)
+            if new_file:
+                writer.writerow(['timestamp', 'revision', 'python', 'command', 'min_ms', 'median_ms', 'max_ms'])
+            for label, low, median, high in rows:
+                writer.writerow([stamp, revision, '.'.join(map(str, sys.version_info[:3])), label,
+                                 round(low, 1), round(median, 1), round(high, 1)])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,197 @@
+#     CT SDE EdSight Data Scraping Command Line Interface.
+#     Copyright (C) 2017  Sasha Cuerda, Connecticut Data Collaborative
+#
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Local stand-in for the EdSight SAS endpoints, used by the benchmarks.
+
+Exports are synthetic csvs sized from the catalog: one row per district (or a handful of schools
+per district, or a single state row) for each subgroup category requested. Latency, HTML error
+pages, "No Search Results" bodies and connection resets can be injected at given rates.
+"""
+
+import asyncio
+import hashlib
+import random
+from urllib.parse import urlparse, parse_qs
+
+from aiohttp import web
+
+PORTAL_PATH = '/SASPortal/main.do'
+EXPORT_PATH = '/SASStoredProcess/do'
+
+CSV_BODY = 'District,Year,Count\n' + 'Some District,2015-16,100\n' * 200
+
+ERROR_PAGE = ('<html><head><title>SAS Stored Process: Error</title></head>'
+              '<body><h2>Stored process error</h2><p>Your session has expired.</p></body></html>')
+NO_RESULTS_PAGE = ('<html><body><div class="message">No Search Results</div>'
+                   '<p>The query you have run did not contain any results.</p></body></html>')
+
+# Fault kinds that can be injected, in the order they are drawn
+FAULTS = ('error', 'no_results', 'reset')
+
+SCHOOLS_PER_DISTRICT = 5
+SUBGROUP_CATEGORIES = 6
+SUBGROUP_FILTERS = ('_subgroup', '_filterby', '_race', '_disability')
+
+
+def _program(url):
+    return parse_qs(urlparse(url).query).get('_program', [None])[0]
+
+
+class SyntheticExports(object):
+    """Builds deterministic csv bodies for a catalog, keyed on the export's _program."""
+
+    def __init__(self, catalog):
+        self.datasets = {}
+        for name, dataset in catalog.items():
+            program = _program(dataset['download_link'])
+            if program is not None:
+                self.datasets.setdefault(program.replace('//', '/'), (name, dataset))
+        self._cache = {}
+
+    def _districts(self, dataset):
+        options = [f['options'] for f in dataset['filters'] if f['name'] == 'District']
+        names = [o for o in (options[0] if options else []) if o not in ('All Districts', 'State of Connecticut')]
+        return names or ['District {}'.format(i) for i in range(170)]
+
+    def body(self, params):
+        """The csv for an export request, or None when the program is not in the catalog."""
+        program = (params.get('_program') or '').replace('//', '/')
+        if program not in self.datasets:
+            return None
+        key = tuple(sorted(params.items()))
+        if key not in self._cache:
+            self._cache[key] = self._build(self.datasets[program], params)
+        return self._cache[key]
+
+    def _build(self, named, params):
+        name, dataset = named
+        state = params.get('_district') == 'State of Connecticut'
+        schools = bool(params.get('_school', '').strip()) and not state
+        grouped = any(params.get(p, '').strip() not in ('', 'All Students') for p in SUBGROUP_FILTERS)
+        places = ['State of Connecticut'] if state else self._districts(dataset)
+        header = ['District', 'District Code'] + (['School', 'School Code'] if schools else [])
+        header += (['Category'] if grouped else []) + ['Count', 'Total', 'Rate']
+        seed = int(hashlib.md5(repr(sorted(params.items())).encode()).hexdigest()[:8], 16)
+        rng = random.Random(seed)
+        lines = [','.join(header)]
+        for code, place in enumerate(places):
+            for school in range(SCHOOLS_PER_DISTRICT if schools else 1):
+                for category in range(SUBGROUP_CATEGORIES if grouped else 1):
+                    total = rng.randint(20, 5000)
+                    count = rng.randint(0, total)
+                    row = ['"{}"'.format(place), '{:03d}0011'.format(code)]
+                    if schools:
+                        row += ['"{} School {}"'.format(place, school), '{:03d}{:02d}11'.format(code, school)]
+                    if grouped:
+                        row.append('Category {}'.format(category))
+                    row += [str(count), str(total), '{:.1f}'.format(100.0 * count / total)]
+                    lines.append(','.join(row))
+        return '\n'.join(lines) + '\n'
+
+
+class StubServer(object):
+    """Serves the portal and export endpoints and counts the TCP connections clients open.
+
+    With a `catalog`, exports are synthetic csvs sized for the requested dataset and filters,
+    otherwise every export is CSV_BODY. `error_rate`, `no_results_rate` and `reset_rate` are the
+    chances that an export request gets an HTML error page, a "No Search Results" page, or has its
+    connection reset. `seed` makes the injected faults repeatable.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, catalog=None, error_rate=0.0, no_results_rate=0.0,
+                 reset_rate=0.0, seed=None):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.exports = SyntheticExports(catalog) if catalog else None
+        self.rates = dict(zip(FAULTS, (error_rate, no_results_rate, reset_rate)))
+        self.random = random.Random(seed)
+        self.connections = set()
+        self.requests = 0
+        self.primes = 0
+        self.faults = dict.fromkeys(FAULTS, 0)
+        self._runner = None
+
+    @property
+    def base_url(self):
+        return 'http://{}:{}{}'.format(self.host, self.port, PORTAL_PATH)
+
+    @property
+    def export_url(self):
+        return 'http://{}:{}{}'.format(self.host, self.port, EXPORT_PATH)
+
+    @property
+    def origin(self):
+        return 'http://{}:{}'.format(self.host, self.port)
+
+    def _track(self, request):
+        self.requests += 1
+        self.connections.add(request.transport.get_extra_info('peername'))
+
+    def _fault(self):
+        draw = self.random.random()
+        for kind in FAULTS:
+            if draw < self.rates[kind]:
+                self.faults[kind] += 1
+                return kind
+            draw -= self.rates[kind]
+        return None
+
+    async def portal(self, request):
+        self._track(request)
+        self.primes += 1
+        response = web.Response(text='<html><head></head><body>EdSight</body></html>',
+                                content_type='text/html')
+        response.set_cookie('JSESSIONID', 'stub')
+        return response
+
+    async def export(self, request):
+        self._track(request)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        fault = self._fault()
+        if fault == 'reset':
+            # Drop the connection without a response, as an overloaded server or proxy would
+            request.transport.abort()
+            return web.Response()
+        if fault == 'error':
+            return web.Response(text=ERROR_PAGE, content_type='text/html')
+        if fault == 'no_results':
+            return web.Response(text=NO_RESULTS_PAGE, content_type='text/html')
+        body = self.exports.body(dict(request.query)) if self.exports else CSV_BODY
+        if body is None:
+            return web.Response(text=ERROR_PAGE, content_type='text/html', status=404)
+        return web.Response(text=body, content_type='text/csv')
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get(PORTAL_PATH, self.portal)
+        app.router.add_get(EXPORT_PATH, self.export)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+    def reset(self):
+        self.connections = set()
+        self.requests = 0
+        self.primes = 0
+        self.faults = dict.fromkeys(FAULTS, 0)
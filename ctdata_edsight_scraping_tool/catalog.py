@@ -0,0 +1,81 @@
+#     CT SDE EdSight Data Scraping Command Line Interface.
+#     Copyright (C) 2017  Sasha Cuerda, Connecticut Data Collaborative
+#
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import hashlib
+import json
+import marshal
+import os
+
+CATALOG_DIR = os.path.join(os.path.dirname(__file__), 'catalog')
+CATALOG_PATH = os.path.join(CATALOG_DIR, 'datasets.json')
+
+# Precompiled catalogs are kept outside the package, which may be installed read-only
+CACHE_DIR = os.environ.get('EDSIGHT_CACHE_DIR') or os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'), 'edsight')
+
+# Bump when the layout of the cache file changes
+CACHE_VERSION = 1
+
+
+def _cache_path(path, cache_dir):
+    name = hashlib.md5(os.path.abspath(path).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(cache_dir, 'catalog-{}.marshal'.format(name))
+
+
+def _write_cache(cache_path, stat, digest, catalog):
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        part = '{}.{}.part'.format(cache_path, os.getpid())
+        with open(part, 'wb') as f:
+            marshal.dump((CACHE_VERSION, stat.st_mtime_ns, stat.st_size, digest), f)
+            marshal.dump(catalog, f)
+        os.replace(part, cache_path)
+    except OSError:
+        # An unwritable cache only costs speed
+        pass
+
+
+def load_catalog(path=CATALOG_PATH, cache_dir=CACHE_DIR):
+    """Load the dataset catalog, from a precompiled marshal copy when it is still current.
+
+    The copy is trusted while the json file's mtime and size are unchanged. When they change, the
+    file is hashed and the copy is still used if the content is the same; otherwise the json is
+    parsed again and the copy rebuilt.
+    """
+    stat = os.stat(path)
+    cache_path = _cache_path(path, cache_dir)
+    raw = None
+    try:
+        with open(cache_path, 'rb') as f:
+            version, mtime, size, digest = marshal.load(f)
+            if version == CACHE_VERSION:
+                if (mtime, size) == (stat.st_mtime_ns, stat.st_size):
+                    return marshal.load(f)
+                with open(path, 'rb') as source:
+                    raw = source.read()
+                if hashlib.sha256(raw).hexdigest() == digest:
+                    catalog = marshal.load(f)
+                    _write_cache(cache_path, stat, digest, catalog)
+                    return catalog
+    except (OSError, EOFError, ValueError, TypeError):
+        pass
+    if raw is None:
+        with open(path, 'rb') as source:
+            raw = source.read()
+    catalog = json.loads(raw.decode('utf-8'))
+    _write_cache(cache_path, stat, hashlib.sha256(raw).hexdigest(), catalog)
+    return catalog
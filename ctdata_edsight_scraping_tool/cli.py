@@ -20,24 +20,16 @@ import json
 import sys
 import os
 import hashlib
+import importlib.util
 
 import click
-import boto
 
-from pkg_resources import resource_string
+# Only light modules are imported here. Commands import what they need (boto, aiohttp, requests,
+# selenium, ...) when they run, so `edsight --help`, `datasets` and `info` start quickly.
+from .catalog import load_catalog
+from .defaults import MAX_ATTEMPTS, FLOOR, CEILING, INITIAL, SHARED_STATE_PATH, REBUILD_WORKERS, REBUILD_BACKEND
 
-from .helpers import _build_catalog_geo_list, custom_slugify
-from .links_prep import rebuild
-
-ASYNC_AVAILABLE = False
-
-# Import sync or async version of fetching routine
-if sys.version_info[0:2] >= (3, 5):
-    from .fetch_async import fetch_async as fetcher
-    from .fetch_sync import fetch_sync as fetcher_sync
-    ASYNC_AVAILABLE = True
-else:
-    from .fetch_sync import fetch_sync as fetcher
+ASYNC_AVAILABLE = sys.version_info[0:2] >= (3, 5)
 
 
 BASE_URL = 'http://edsight.ct.gov/SASPortal/main.do'
@@ -49,6 +41,8 @@ HEADERS = {
 
 LINKS_DIR = os.path.join(os.path.dirname(__file__), 'catalog')
 LINKS_PATH = os.path.join(LINKS_DIR, 'datasets.json')
+# ETag of the S3 object the local catalog was downloaded from
+ETAG_PATH = LINKS_PATH + '.etag'
 BUCKET_NAME = 'edsightcli'
 
 
@@ -62,29 +56,105 @@ def get_md5(filename):
     m.update(data)
   return m.hexdigest()
 
-def _get_remote_catalog_file():
+def _clean_etag(etag):
+    return etag.strip("'").strip('"')
+
+def _local_etag():
+    """ETag of the local catalog, from the sidecar file. Catalogs from before the sidecar are hashed once."""
+    try:
+        with open(ETAG_PATH) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        pass
+    if not os.path.exists(LINKS_PATH):
+        return None
+    etag = get_md5(LINKS_PATH)
+    _write_local_etag(etag)
+    return etag
+
+def _write_local_etag(etag):
+    part = ETAG_PATH + '.part'
+    with open(part, 'w') as f:
+        f.write(etag)
+    os.replace(part, ETAG_PATH)
+
+def _get_remote_catalog_file(etag=None):
+    """Look up the remote catalog with a single HEAD request. Returns None if it still matches `etag`.
+
+    Raises a ClickException if the bucket has no catalog at all, rather than passing that off as up to date.
+    """
+    import boto
+    from boto.exception import S3ResponseError
     conn = boto.connect_s3()
-    bucket = conn.get_bucket(BUCKET_NAME)
-    return bucket.get_key('datasets.json')
+    # Skip validating the bucket, which would cost another round trip
+    bucket = conn.get_bucket(BUCKET_NAME, validate=False)
+    headers = {'If-None-Match': '"{}"'.format(etag)} if etag else None
+    try:
+        key = bucket.get_key('datasets.json', headers=headers)
+    except S3ResponseError as e:
+        if e.status == 304:
+            return None
+        raise
+    # boto answers a 404 with None too
+    if key is None:
+        raise click.ClickException("There is no datasets.json in the {} bucket.".format(BUCKET_NAME))
+    return key
+
+def _validate_catalog(path):
+    with open(path, 'rb') as f:
+        links = json.loads(f.read().decode('utf-8'))
+    if not isinstance(links, dict) or not links:
+        raise ValueError("The downloaded catalog has no datasets.")
+    for name, d in links.items():
+        if not isinstance(d, dict) or 'filters' not in d or 'download_link' not in d:
+            raise ValueError("The downloaded catalog entry for {} is malformed.".format(name))
+
+class _HashingWriter(object):
+    def __init__(self, f):
+        self.f = f
+        self.md5 = hashlib.md5()
+
+    def write(self, data):
+        self.md5.update(data)
+        return self.f.write(data)
 
 def _replace_local_catalog(s3_catalog_file_object):
-    links = json.loads(s3_catalog_file_object.get_contents_as_string())
+    """Stream the remote catalog to a temp file, validate it and atomically swap it in."""
     if not os.path.isdir(LINKS_DIR):
         os.makedirs(LINKS_DIR)
-    with open(LINKS_PATH, 'w') as f:
-        json.dump(links, f)
+    etag = _clean_etag(s3_catalog_file_object.etag)
+    part = LINKS_PATH + '.part'
+    try:
+        with open(part, 'wb') as f:
+            writer = _HashingWriter(f)
+            s3_catalog_file_object.get_contents_to_file(writer)
+        # Multipart uploads have ETags that are not a plain md5 of the content
+        if '-' not in etag and writer.md5.hexdigest() != etag:
+            raise ValueError("The downloaded catalog does not match its ETag.")
+        _validate_catalog(part)
+        os.replace(part, LINKS_PATH)
+    finally:
+        if os.path.exists(part):
+            os.remove(part)
+    _write_local_etag(etag)
 
 def _catalog_update():
     s3_file = _get_remote_catalog_file()
     _replace_local_catalog(s3_file)
 
 
-try:
-    links = json.loads(resource_string(__name__, 'catalog/datasets.json'))
-except FileNotFoundError:
-    _catalog_update()
+_links = None
 
 
+def get_links():
+    """The dataset catalog, fetched from S3 if there is no local copy yet and loaded on first use."""
+    global _links
+    if _links is None:
+        if not os.path.exists(LINKS_PATH):
+            _catalog_update()
+        _links = load_catalog(LINKS_PATH)
+    return _links
+
 
 @click.group()
 def main(args=None):
@@ -103,16 +173,96 @@ def main(args=None):
               help="Force update of local catalog file.")
 def update_catalog(force):
     """Check local data catalog index against remote and update if remote has new data."""
-    s3_file = _get_remote_catalog_file()
-    s3_etag = s3_file.etag.strip("'").strip('"')
+    local_etag = None if force else _local_etag()
+    s3_file = _get_remote_catalog_file(local_etag)
 
-    if s3_etag != get_md5(LINKS_PATH) or force:
-        _replace_local_catalog(s3_file)
+    if s3_file is not None and _clean_etag(s3_file.etag) != local_etag:
         click.echo("Refreshing the dataset catalog...")
+        _replace_local_catalog(s3_file)
     else:
         click.echo("Catalog is the latest version.")
 
 
+def _run_metrics(jobs, report, prometheus):
+    """A RunMetrics for the given (dataset, output_dir, geography) jobs, if a report was asked for."""
+    if not (report or prometheus):
+        return None
+    from .metrics import RunMetrics
+    metrics = RunMetrics()
+    for dataset, output_dir, geography in jobs:
+        metrics.add_job(dataset, output_dir, geography)
+    return metrics
+
+
+def _start_progress(mode, targets, journal, resume):
+    """Start the --progress display, counting the targets up front when it shows a total and an ETA.
+
+    Counting only walks the planning generators again; nothing is fetched. The line per file and the
+    quiet modes never show a total, so they start fetching right away.
+    """
+    from .progress import make_progress
+    if mode is None:
+        mode = 'bar' if sys.stderr.isatty() else 'quiet'
+    total = None
+    if mode in ('bar', 'jsonl'):
+        if resume:
+            targets = journal.pending(targets)
+        total = sum(1 for _ in targets)
+    return make_progress(mode, total).start()
+
+
+def _catalog_jobs(links, output_dir):
+    """The (dataset, output_dir, geography) jobs of a catalog fetch, creating their directories.
+
+    Datasets whose targets cannot be planned are reported and skipped, as `plan` does, so that one
+    of them does not stop the whole run.
+    """
+    from .helpers import _build_catalog_geo_list, _iter_download_targets, custom_slugify
+    jobs = []
+    for d in _build_catalog_geo_list(links):
+        for g in d['geos']:
+            target_dir = os.path.join(output_dir, custom_slugify("{} {}".format(d['dataset'], g)))
+            try:
+                next(_iter_download_targets(d['dataset'], target_dir, g, links), None)
+            except KeyError as e:
+                click.echo("{} ({}): cannot be planned, missing filter {}".format(d['dataset'], g, e), err=True)
+                continue
+            if not os.path.exists(target_dir):
+                os.makedirs(target_dir)
+            jobs.append((d['dataset'], target_dir, g))
+    return jobs
+
+
+def _store(output_dir, dedupe):
+    if not dedupe:
+        return None
+    from .store import Store
+    return Store.for_directory(output_dir)
+
+
+def _finish_run(progress, store, limiter, metrics, report, prometheus):
+    """Summarize a finished fetch and write its --report and --prometheus files.
+
+    With --progress jsonl the summary goes to stderr, so that stdout stays pure JSON lines.
+    """
+    err = getattr(progress, 'mode', None) == 'jsonl'
+    if store is not None:
+        click.echo("{} distinct files stored, {} duplicates linked, {} bytes saved".format(
+            store.stored, store.deduplicated, store.bytes_saved), err=err)
+    if limiter is not None:
+        click.echo("Concurrency limit: {}".format(', '.join(
+            "{} after {:.0f}s".format(limit, seconds) if seconds else str(limit)
+            for seconds, limit in limiter.history)), err=err)
+        if metrics is not None:
+            metrics.limit_history = limiter.history
+    if report:
+        metrics.write_json(report)
+        click.echo("Run report written to {}".format(report), err=err)
+    if prometheus:
+        metrics.write_prometheus(prometheus)
+        click.echo("Prometheus metrics written to {}".format(prometheus), err=err)
+
+
 @main.command()
 def warranty():
     """Display GPL 3.0 warranty clause"""
@@ -155,47 +305,128 @@ def conditions():
     """)
 
 @main.command()
-@click.option('--async', '-a',
+@click.option('--async', '-a', 'use_async',
               is_flag=True,
-              help="""Use the faster, asynchronous download with Python 3.5+. Limited to ten concurrent connections to
-              respect the EdSight servers""")
+              help="""Use the faster, asynchronous download with Python 3.5+. Concurrent connections adapt between
+              --min-connections and --max-connections to respect the EdSight servers""")
+@click.option('--threads', '-t',
+              type=int,
+              default=None,
+              help="""Download on this many threads using only requests, for hosts without the async dependencies.
+              Cannot be combined with --async.""")
 @click.option('--output_dir', '-o',
               required=True,
               help="Full or relative path for storing downloaded files.",
               default='./')
 @click.option('--reprocess', '-r',
-              help="Overwrite existing scrape results in target directory. Defaults to not overwriting.",
+              help="""Overwrite existing scrape results in target directory. Defaults to resuming, which only fetches
+              files that are missing or failed on an earlier run.""",
               is_flag=True)
-def fetch_catalog(async, output_dir, reprocess):
+@click.option('--max-attempts',
+              default=MAX_ATTEMPTS,
+              show_default=True,
+              help="Maximum number of attempts for any single file.")
+@click.option('--retry-budget',
+              type=int,
+              default=None,
+              help="Maximum number of retries across the whole run. Unlimited by default.")
+@click.option('--min-connections',
+              default=FLOOR,
+              show_default=True,
+              help="Fewest concurrent connections the async downloader backs off to when EdSight is struggling.")
+@click.option('--max-connections',
+              default=CEILING,
+              show_default=True,
+              help="Most concurrent connections the async downloader ramps up to when EdSight is responsive.")
+@click.option('--rate',
+              type=float,
+              default=None,
+              help="""Maximum requests per second. The budget is shared with every other edsight process on this host
+              that uses the same --rate-file. Unlimited by default.""")
+@click.option('--rate-file',
+              default=SHARED_STATE_PATH,
+              show_default=True,
+              help="State file used to share the --rate budget between processes.")
+@click.option('--report',
+              default=None,
+              help="Write per-dataset latency percentiles, throughput and outcomes for the run to this JSON file.")
+@click.option('--prometheus',
+              default=None,
+              help="Write the same run metrics to this file for the Prometheus node exporter's textfile collector.")
+@click.option('--compress',
+              type=click.Choice(['gzip', 'zstd']),
+              default=None,
+              help="Compress files as they are written, as .csv.gz or .csv.zst. zstd needs the zstandard package.")
+@click.option('--progress', 'progress_mode',
+              type=click.Choice(['bar', 'log', 'quiet', 'jsonl']),
+              default=None,
+              help="""How to report progress: a live status line (bar), a line per file (log), only failures and a
+              summary (quiet), or JSON lines on stdout (jsonl). Defaults to bar in a terminal and quiet otherwise.""")
+@click.option('--dedupe',
+              is_flag=True,
+              help="""Store identical files once, in .edsight-store under the output directory, and make the files in
+              the usual layout hardlinks to them (or reflinks or copies where hardlinks are not possible).""")
+def fetch_catalog(use_async, threads, output_dir, reprocess, max_attempts, retry_budget, min_connections,
+                  max_connections, rate, rate_file, report, prometheus, progress_mode, compress, dedupe):
     """Download all datasets. This will take a while even if using the async versions."""
     if not os.path.isdir(output_dir):
         raise NotADirectoryError("{} not a valid directory".format(output_dir))
-    to_get = _build_catalog_geo_list(links)
-    for d in to_get:
-        for g in d['geos']:
-            target_dir_name = custom_slugify("{} {}".format(d['dataset'], g))
-            target_dir = os.path.join(output_dir, target_dir_name)
-            if not reprocess and os.path.exists(target_dir):
-                click.echo(f'{d["dataset"]} already exists. Skipping.')
-                continue
-            if not os.path.exists(target_dir):
-                os.makedirs(target_dir)
-            if async and ASYNC_AVAILABLE:
-                fetcher(d['dataset'], target_dir, g, links, save=True)
-            elif async and not ASYNC_AVAILABLE:
-                click.echo("Sorry, but the async downloader is not available on your platform.")
-                if click.confirm("Do you want to proceed with the default downloader?"):
-                    fetcher_sync(d['dataset'], target_dir, g, links, save=True)
-            else:
-                fetcher_sync(d['dataset'], target_dir, g, links, save=True)
+    if use_async and threads:
+        raise click.UsageError("Choose either --async or --threads.")
+    if compress == 'zstd' and importlib.util.find_spec('zstandard') is None:
+        raise click.UsageError("--compress zstd needs the zstandard package: pip install zstandard")
+    if use_async and not ASYNC_AVAILABLE:
+        click.echo("Sorry, but the async downloader is not available on your platform.")
+        if not click.confirm("Do you want to proceed with the default downloader?"):
+            return
+        use_async = False
+    from .helpers import _setup_catalog_targets
+    from .journal import Journal
+    from .ratelimit import TokenBucket
+    from .retry import RetryPolicy
+    links = get_links()
+    jobs = _catalog_jobs(links, output_dir)
+    # One policy for the whole run, so the retry budget covers the entire catalog
+    policy = RetryPolicy(max_attempts=max_attempts, budget=retry_budget)
+    # Every file is recorded in the journal as it finishes; unless reprocessing, only the files that
+    # are missing or failed get fetched.
+    journal = Journal.for_directory(output_dir)
+    bucket = TokenBucket(rate, path=rate_file) if rate else None
+    metrics = _run_metrics(jobs, report, prometheus)
+    progress = _start_progress(progress_mode, _setup_catalog_targets(jobs, links, compress), journal, not reprocess)
+    options = dict(save=True, retry_policy=policy, journal=journal, resume=not reprocess, bucket=bucket,
+                   metrics=metrics, progress=progress, compression=compress, store=_store(output_dir, dedupe))
+    limiter = None
+    try:
+        if use_async:
+            from .fetch_async import fetch_catalog_async
+            from .limits import AdaptiveLimiter
+            # Every dataset and geography shares one event loop and one work queue.
+            limiter = AdaptiveLimiter(min_connections, max_connections, on_change=progress.limit_changed)
+            fetch_catalog_async(jobs, links, limiter=limiter, **options)
+        elif threads:
+            from .fetch_sync import fetch_catalog_threaded
+            fetch_catalog_threaded(jobs, links, threads=threads, **options)
+        else:
+            from .fetch_sync import fetch_catalog_sync
+            fetch_catalog_sync(jobs, links, **options)
+    finally:
+        progress.close()
+        journal.close()
+    _finish_run(progress, options['store'], limiter, metrics, report, prometheus)
 
 
 # TODO Refactor the geography arg to be just a flag for school, since that's all it does anyway
 @main.command()
-@click.option('--async', '-a',
+@click.option('--async', '-a', 'use_async',
               is_flag=True,
-              help="""Use the faster, asynchronous download with Python 3.5+. Limited to ten concurrent connections to
-                           respect the EdSight servers""")
+              help="""Use the faster, asynchronous download with Python 3.5+. Concurrent connections adapt between
+                           --min-connections and --max-connections to respect the EdSight servers""")
+@click.option('--threads', '-t',
+              type=int,
+              default=None,
+              help="""Download on this many threads using only requests, for hosts without the async dependencies.
+              Cannot be combined with --async.""")
 @click.option('--dataset', '-d',
               required=True,
               help="Name of the dataset to retrieve. Should conform to names output by the info cmd.")
@@ -207,30 +438,221 @@ def fetch_catalog(async, output_dir, reprocess):
               required=True,
               help='District or school',
               default='District')
-def fetch(dataset, geography, output_dir, async):
+@click.option('--resume',
+              is_flag=True,
+              help="Only fetch files that are missing or failed on an earlier run into the same directory.")
+@click.option('--max-attempts',
+              default=MAX_ATTEMPTS,
+              show_default=True,
+              help="Maximum number of attempts for any single file.")
+@click.option('--retry-budget',
+              type=int,
+              default=None,
+              help="Maximum number of retries across the whole run. Unlimited by default.")
+@click.option('--min-connections',
+              default=FLOOR,
+              show_default=True,
+              help="Fewest concurrent connections the async downloader backs off to when EdSight is struggling.")
+@click.option('--max-connections',
+              default=CEILING,
+              show_default=True,
+              help="Most concurrent connections the async downloader ramps up to when EdSight is responsive.")
+@click.option('--rate',
+              type=float,
+              default=None,
+              help="""Maximum requests per second. The budget is shared with every other edsight process on this host
+              that uses the same --rate-file. Unlimited by default.""")
+@click.option('--rate-file',
+              default=SHARED_STATE_PATH,
+              show_default=True,
+              help="State file used to share the --rate budget between processes.")
+@click.option('--report',
+              default=None,
+              help="Write per-dataset latency percentiles, throughput and outcomes for the run to this JSON file.")
+@click.option('--prometheus',
+              default=None,
+              help="Write the same run metrics to this file for the Prometheus node exporter's textfile collector.")
+@click.option('--compress',
+              type=click.Choice(['gzip', 'zstd']),
+              default=None,
+              help="Compress files as they are written, as .csv.gz or .csv.zst. zstd needs the zstandard package.")
+@click.option('--progress', 'progress_mode',
+              type=click.Choice(['bar', 'log', 'quiet', 'jsonl']),
+              default=None,
+              help="""How to report progress: a live status line (bar), a line per file (log), only failures and a
+              summary (quiet), or JSON lines on stdout (jsonl). Defaults to bar in a terminal and quiet otherwise.""")
+@click.option('--dedupe',
+              is_flag=True,
+              help="""Store identical files once, in .edsight-store under the output directory, and make the files in
+              the usual layout hardlinks to them (or reflinks or copies where hardlinks are not possible).""")
+def fetch(dataset, geography, output_dir, use_async, threads, resume, max_attempts, retry_budget, min_connections,
+          max_connections, rate, rate_file, report, prometheus, progress_mode, compress, dedupe):
     """Download all variable combinations for the given geography of the dataset to a target directory."""
     if not os.path.isdir(output_dir):
         raise NotADirectoryError("{} not a valid directory".format(output_dir))
-    if async and ASYNC_AVAILABLE:
-        fetcher(dataset, output_dir, geography, links, save=True)
-    elif async and not ASYNC_AVAILABLE:
+    if use_async and threads:
+        raise click.UsageError("Choose either --async or --threads.")
+    if compress == 'zstd' and importlib.util.find_spec('zstandard') is None:
+        raise click.UsageError("--compress zstd needs the zstandard package: pip install zstandard")
+    if use_async and not ASYNC_AVAILABLE:
         click.echo("Sorry, but the async downloader is not available on your platform.")
-        if click.confirm("Do you want to proceed with the default downloader?"):
-            fetcher_sync(dataset, output_dir, geography, links, save=True)
+        if not click.confirm("Do you want to proceed with the default downloader?"):
+            return
+        use_async = False
+    from .helpers import _iter_download_targets
+    from .journal import Journal
+    from .ratelimit import TokenBucket
+    from .retry import RetryPolicy
+    from .fetch_sync import fetch_sync, fetch_threaded
+    links = get_links()
+    policy = RetryPolicy(max_attempts=max_attempts, budget=retry_budget)
+    journal = Journal.for_directory(output_dir)
+    bucket = TokenBucket(rate, path=rate_file) if rate else None
+    metrics = _run_metrics([(dataset, output_dir, geography)], report, prometheus)
+    progress = _start_progress(progress_mode, _iter_download_targets(dataset, output_dir, geography, links, compress),
+                               journal, resume)
+    options = dict(save=True, retry_policy=policy, journal=journal, resume=resume, bucket=bucket, metrics=metrics,
+                   progress=progress, compression=compress, store=_store(output_dir, dedupe))
+    limiter = None
+    try:
+        if use_async:
+            from .fetch_async import fetch_async
+            from .limits import AdaptiveLimiter
+            limiter = AdaptiveLimiter(min_connections, max_connections, on_change=progress.limit_changed)
+            fetch_async(dataset, output_dir, geography, links, limiter=limiter, **options)
+        elif threads:
+            fetch_threaded(dataset, output_dir, geography, links, threads=threads, **options)
+        else:
+            fetch_sync(dataset, output_dir, geography, links, **options)
+    finally:
+        progress.close()
+        journal.close()
+    _finish_run(progress, options['store'], limiter, metrics, report, prometheus)
+
+
+@main.command()
+@click.option('--dataset', '-d',
+              multiple=True,
+              help="Dataset to plan. Repeat for several. Defaults to the whole catalog.")
+@click.option('--geography', '-g',
+              multiple=True,
+              type=click.Choice(['District', 'School']),
+              help="Geography to plan. Repeat for both. Defaults to every geography a dataset offers.")
+@click.option('--output_dir', '-o',
+              default='./',
+              help="Directory a fetch-catalog run would write to. Files already there are not counted as pending.")
+@click.option('--concurrency', '-c',
+              default=INITIAL,
+              show_default=True,
+              help="Concurrent requests to assume: the thread count, or the async connection count.")
+@click.option('--rate',
+              type=float,
+              default=None,
+              help="Maximum requests per second the run would be limited to.")
+def plan(dataset, geography, output_dir, concurrency, rate):
+    """Show how many requests a fetch-catalog run would make and roughly how long it would take.
+
+    Nothing is downloaded. The estimate uses the latencies recorded in the output directory's journal by
+    earlier runs, when there are any.
+    """
+    from .helpers import _build_catalog_geo_list, custom_slugify
+    from .plan import plan_dataset, open_journal, estimate_seconds
+    links = get_links()
+    unknown = [d for d in dataset if d not in links]
+    if unknown:
+        raise click.BadParameter("unknown dataset(s): {}".format(", ".join(unknown)), param_hint='--dataset')
+    journal = open_journal(output_dir)
+    plans = []
+    for d in _build_catalog_geo_list(links):
+        if dataset and d['dataset'] not in dataset:
+            continue
+        geographies = [(os.path.join(output_dir, custom_slugify("{} {}".format(d['dataset'], g))), g)
+                       for g in d['geos'] if not geography or g in geography]
+        try:
+            plans.extend(plan_dataset(d['dataset'], geographies, links, journal))
+        except KeyError as e:
+            click.echo("{}: cannot be planned, missing filter {}".format(d['dataset'], e), err=True)
+    if journal is not None:
+        journal.close()
+    total = estimate_seconds(plans, concurrency, rate)
+    for p in plans:
+        click.echo("{dataset} ({geography}): {files} files from {targets} requests, {done} done, "
+                   "{remaining} to fetch, ~{seconds:.0f}s at {latency:.2f}s per request".format(**p))
+    click.echo("Total: {} files from {} requests, {} done, {} requests to make, ~{:.1f} minutes at concurrency {}".format(
+        sum(p['files'] for p in plans), sum(p['targets'] for p in plans), sum(p['done'] for p in plans),
+        sum(p['remaining'] for p in plans), total / 60, concurrency))
+
+
+@main.command()
+@click.option('--dataset', '-d',
+              default=None,
+              help="""Dataset whose files are directly in --input_dir, as written by fetch. Without it, every dataset
+              and geography directory of a fetch-catalog run in --input_dir is consolidated.""")
+@click.option('--geography', '-g',
+              type=click.Choice(['District', 'School']),
+              default='District',
+              show_default=True,
+              help="Geography the --dataset files were fetched for.")
+@click.option('--input_dir', '-i',
+              default='./',
+              help="Directory the csv files were fetched to.")
+@click.option('--output_dir', '-o',
+              default=None,
+              help="Directory for the consolidated files. Defaults to --input_dir.")
+@click.option('--format', '-f', 'fmt',
+              type=click.Choice(['parquet', 'feather']),
+              default='parquet',
+              show_default=True,
+              help="Columnar format to write.")
+def consolidate(dataset, geography, input_dir, output_dir, fmt):
+    """Combine the csv files of each dataset and geography into a single Parquet or Feather file.
+
+    The filter values each file was fetched with become columns. Needs pyarrow.
+    """
+    try:
+        from .consolidate import consolidate as consolidate_job, FORMATS
+    except ImportError:
+        raise click.ClickException("Consolidating needs pyarrow. Install it with `pip install pyarrow`.")
+    from .helpers import _build_catalog_geo_list, custom_slugify
+    links = get_links()
+    output_dir = output_dir or input_dir
+    if dataset:
+        jobs = [(dataset, input_dir, geography)]
     else:
-        fetcher_sync(dataset, output_dir, geography, links, save=True)
+        jobs = []
+        for d in _build_catalog_geo_list(links):
+            for g in d['geos']:
+                target_dir = os.path.join(input_dir, custom_slugify("{} {}".format(d['dataset'], g)))
+                if os.path.isdir(target_dir):
+                    jobs.append((d['dataset'], target_dir, g))
+    for d, target_dir, g in jobs:
+        path = os.path.join(output_dir, custom_slugify("{} {}".format(d, g)) + FORMATS[fmt])
+        files, rows = consolidate_job(d, target_dir, g, links, path, fmt)
+        click.echo("{} ({}): {} files, {} rows -> {}".format(d, g, files, rows, path))
 
 
-# @main.command()
-# @click.option('--target', '-t', required=True)
-# def refresh(target):
-#     """Update the dataset manifest file with a refreshed list of possible variables."""
-#     rebuild(links, target)
+@main.command()
+@click.option('--target', '-t', required=True)
+@click.option('--backend',
+              type=click.Choice(['http', 'browser']),
+              default=REBUILD_BACKEND,
+              help="""Read the report pages over plain HTTP (http), or drive headless Chrome through selenium
+              (browser), which needs selenium and chromedriver.""")
+@click.option('--workers', '-w',
+              type=int,
+              default=REBUILD_WORKERS,
+              help="How many report pages to read at once.")
+def refresh(target, backend, workers):
+    """Update the dataset manifest file with a refreshed list of possible variables."""
+    if backend == 'browser' and importlib.util.find_spec('selenium') is None:
+        raise click.UsageError("--backend browser needs selenium: pip install selenium")
+    from .links_prep import rebuild
+    rebuild(get_links(), target, workers, backend)
 
 @main.command()
 def datasets(args=None):
     """List datasets that are available for scraping"""
-    for d in links.items():
+    for d in get_links().items():
         click.echo(d[0])
 
 @main.command()
@@ -238,7 +660,7 @@ def datasets(args=None):
 @click.option('--variable', '-v', required=False)
 def info(dataset, variable):
     """Information about a dataset. Takes dataset name as an argument."""
-    filters = links[dataset]['filters']
+    filters = get_links()[dataset]['filters']
     if variable:
         var = [f for f in filters if f['name'] == variable][0]
         options = var['options']
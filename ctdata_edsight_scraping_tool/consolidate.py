@@ -0,0 +1,143 @@
+#     CT SDE EdSight Data Scraping Command Line Interface.
+#     Copyright (C) 2017  Sasha Cuerda, Connecticut Data Collaborative
+#
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import csv
+import os
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pyarrow import feather
+
+from .helpers import _iter_download_targets
+from .output import find, open_text
+
+FORMATS = {'parquet': '.parquet', 'feather': '.feather'}
+
+# Rows buffered before they are written out, so small files are packed into sensible row groups
+ROWS_PER_BATCH = 64 * 1024
+
+
+def _filter_columns(dataset, catalog):
+    """Map each filter's param name to the column its values go in."""
+    return {f['xpath_id']: f['name'] for f in catalog[dataset]['filters']}
+
+
+def _filter_values(params, filter_columns):
+    values = {}
+    for param, value in params.items():
+        if param in filter_columns:
+            values[filter_columns[param]] = value.strip() or None
+    return values
+
+
+def plan_columns(targets):
+    """First pass: the union of every file's header, in first-seen order.
+
+    Returns the columns and the targets with a file on disk, plain or compressed, each with the path
+    of that file.
+    """
+    columns, present = [], []
+    for t in targets:
+        path = find(t['filename'])
+        if path is None:
+            continue
+        present.append((t, path))
+        with open_text(path) as f:
+            header = next(csv.reader(f), [])
+        for c in header:
+            if c not in columns:
+                columns.append(c)
+    return columns, present
+
+
+class _Writer(object):
+    """Buffers rows as columns and writes them out as record batches."""
+
+    def __init__(self, path, schema, fmt):
+        self.schema = schema
+        self.buffer = {name: [] for name in schema.names}
+        self.rows = 0
+        if fmt == 'parquet':
+            self.writer = pq.ParquetWriter(path, schema)
+        else:
+            self.writer = pa.ipc.new_file(path, schema)
+
+    def append(self, row):
+        for name, column in self.buffer.items():
+            column.append(row.get(name))
+        self.rows += 1
+        if self.rows >= ROWS_PER_BATCH:
+            self.flush()
+
+    def flush(self):
+        if self.rows:
+            batch = pa.record_batch([pa.array(self.buffer[n], pa.string()) for n in self.schema.names],
+                                    schema=self.schema)
+            self.writer.write_batch(batch)
+            self.buffer = {name: [] for name in self.schema.names}
+            self.rows = 0
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
+def consolidate(dataset, output_dir, geography, catalog, path, fmt='parquet'):
+    """Stream every downloaded csv of a dataset and geography into one Parquet or Feather file at `path`.
+
+    Files are streamed one at a time, in two passes: the first reads only their headers to collect the
+    union of columns, the second writes their rows, with the filter values of each file's params as extra columns. All
+    values are kept as text, since EdSight suppresses small counts with markers such as '*'.
+    Returns the number of files and rows written.
+    """
+    filter_columns = _filter_columns(dataset, catalog)
+    targets = _iter_download_targets(dataset, output_dir, geography, catalog)
+    columns, present = plan_columns(targets)
+    # A filter can share its name with a csv column, e.g. District; keep both
+    renamed = {name: '{} (filter)'.format(name) for name in filter_columns.values() if name in columns}
+    filters = [renamed.get(name, name) for name in filter_columns.values()]
+    schema = pa.schema([(name, pa.string()) for name in columns + filters])
+    part = path + '.part'
+    writer = _Writer(part, schema, fmt)
+    rows = 0
+    try:
+        for t, filename in present:
+            values = {renamed.get(k, k): v for k, v in _filter_values(t['param'], filter_columns).items()}
+            with open_text(filename) as f:
+                reader = csv.reader(f)
+                header = next(reader, [])
+                for record in reader:
+                    if not record:
+                        continue
+                    row = dict(values)
+                    row.update(zip(header, record))
+                    writer.append(row)
+                    rows += 1
+        writer.close()
+    except BaseException:
+        writer.writer.close()
+        os.remove(part)
+        raise
+    os.replace(part, path)
+    return len(present), rows
+
+
+def read(path):
+    """Load a consolidated file back as a pyarrow Table."""
+    if path.endswith(FORMATS['feather']):
+        return feather.read_table(path)
+    return pq.read_table(path)
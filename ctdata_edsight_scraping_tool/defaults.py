@@ -0,0 +1,49 @@
+#     CT SDE EdSight Data Scraping Command Line Interface.
+#     Copyright (C) 2017  Sasha Cuerda, Connecticut Data Collaborative
+#
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Defaults shared by the downloaders and the command line options.
+
+Kept free of heavy imports so the CLI can declare its options without loading the download machinery.
+"""
+
+import os
+import tempfile
+
+# Retries (see retry.RetryPolicy)
+MAX_ATTEMPTS = 4
+BASE_DELAY = .75
+MAX_DELAY = 30
+
+# Seconds to wait for a connection, and then between bytes of a response, before a request counts as
+# a network error and is retried. Without them one stalled socket can hang a run.
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 60
+
+# Adaptive concurrency for the async downloader (see limits.AdaptiveLimiter)
+FLOOR = 2
+CEILING = 20
+INITIAL = 10
+
+# Headless browsers used to rebuild the catalog (see links_prep.build_links_object_json)
+REBUILD_WORKERS = 4
+# 'http' parses the report pages directly; 'browser' drives headless Chrome through selenium
+REBUILD_BACKEND = 'http'
+
+# Processes that point at the same rate limit state file share one budget. The default lives in the
+# system temp directory so every `edsight` run on a host finds it without configuration, named per
+# user because another user's file there is not writable.
+SHARED_STATE_PATH = os.path.join(tempfile.gettempdir(), 'edsight-ratelimit' + (
+    '-{}'.format(os.getuid()) if hasattr(os, 'getuid') else ''))
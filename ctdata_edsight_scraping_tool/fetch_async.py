@@ -15,65 +15,177 @@
 #     along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
-import os
 import time
-import click
 import asyncio
 import aiofiles
 import aiohttp
 
-from .helpers import _setup_download_targets
-
-sema = asyncio.BoundedSemaphore(10)
-
-BASE_URL = 'http://edsight.ct.gov/SASPortal/main.do'
-HEADERS = {
-    'user-agent': ('Mozilla/5.0 (Macintosh; Intel Mac OS X 10_10_5) '
-                   'AppleWebKit/537.36 (KHTML, like Gecko) '
-                   'Chrome/45.0.2454.101 Safari/537.36'),
-}
-
-async def get_report(url, params, file, save):
-    async with sema:
-        scraped = False
-        while not scraped:
-            try:
-                async with aiohttp.ClientSession() as session:
-                    data = '<html>'
-                    tries = 0
-                    target_url = ''
-                    while tries < 4 and data.find('<html>') != -1:
-                        if tries > 0:
-                            click.echo("Try #{} for fetching {}".format(tries+1, target_url))
-                            time.sleep(.75)
-                        async with session.get(BASE_URL, headers=HEADERS) as context:
-                            pass
-                        async with session.get(url, headers=HEADERS, params=params) as resp:
-                            data = await resp.text()
-                            target_url = resp.url
-                        tries += 1
-                    if save:
-                        no_results = (data.find('No Search Results') != -1) or (data.find('The query you have run did not contain any results.') != -1)
-                        bad_response = data.find('<head>') != -1
-                        if not no_results and not bad_response:
-                            async with aiofiles.open(file, 'w') as f:
-                                click.echo('Saving {} on try: {}\n'.format(os.path.basename(file), tries+1))
-                                await f.write(data)
-                        elif no_results:
-                            click.echo("\n{} failed.\nThe query you have run did not contain any results.\n".format(target_url))
-                        elif bad_response:
-                            click.echo("\n{} failed.\bBad response from the EdSight server.\n".format(target_url))
-                        else:
-                            click.echo("\n{} failed.\bSomething unexpected happened.".format(target_url))
-                    scraped = True
-            except aiohttp.client_exceptions.ClientOSError as e:
-                scraped = False
-
-def fetch_async(dataset, output_dir, geography, catalog, save=True):
-    targets = _setup_download_targets(dataset, output_dir, geography, catalog)
+from .helpers import _iter_download_targets, _setup_catalog_targets
+from .defaults import CONNECT_TIMEOUT, READ_TIMEOUT
+from .limits import AdaptiveLimiter
+from .output import CHUNK_SIZE, saving
+from .progress import EchoProgress
+from .responses import SAVED, NO_RESULTS, BAD_RESPONSE, NETWORK_ERROR, classify, make_result
+from .retry import RetryPolicy
+from .session import BASE_URL, HEADERS, SNIFF_SIZE, AsyncSessionPrimer
+
+# Number of requests kept in flight when a run starts. A run (one dataset or the whole catalog) is a
+# single work queue, and an adaptive limiter moves the number of requests in flight up or down from
+# here depending on how the EdSight server is coping.
+CONCURRENCY = 10
+
+# Connection pool defaults for the shared session. EdSight is a single host, so the per-host limit
+# is what actually bounds the pool; keep-alive and the DNS cache let every target reuse the same
+# handful of warm connections instead of opening a new one per request.
+LIMIT_PER_HOST = CONCURRENCY
+KEEPALIVE_TIMEOUT = 30
+TTL_DNS_CACHE = 300
+
+def build_session(limit_per_host=LIMIT_PER_HOST, keepalive_timeout=KEEPALIVE_TIMEOUT,
+                  ttl_dns_cache=TTL_DNS_CACHE, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT,
+                  total_timeout=None):
+    """Create the long-lived, pooled client session shared by every request of a run.
+
+    Like the requests based downloaders, a request times out waiting for a connection or between
+    reads. There is no total timeout unless one is given, so a large export that keeps arriving is
+    never cut off.
+    """
+    connector = aiohttp.TCPConnector(limit_per_host=limit_per_host,
+                                     keepalive_timeout=keepalive_timeout,
+                                     ttl_dns_cache=ttl_dns_cache)
+    timeout = aiohttp.ClientTimeout(total=total_timeout, connect=connect_timeout, sock_read=read_timeout)
+    return aiohttp.ClientSession(connector=connector, headers=HEADERS, timeout=timeout)
+
+
+async def _read_head(content):
+    """Pull chunks off the body until there is enough of it to classify."""
+    head = b''
+    while len(head) < SNIFF_SIZE:
+        chunk = await content.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        head += chunk
+    return head
+
+
+async def _save(file, head, content, store=None, also=()):
+    with saving(file, store, also) as (part, body):
+        async with aiofiles.open(part, 'wb') as f:
+            await f.write(body.feed(head))
+            async for chunk in content.iter_chunked(CHUNK_SIZE):
+                await f.write(body.feed(chunk))
+            await f.write(body.finish())
+    return body
+
+
+async def get_report(session, primer, policy, url, params, file, save, bucket=None, progress=None,
+                     store=None, also=()):
+    """Fetch one export, streaming the body to `file` once its first chunk checks out."""
+    progress = progress or EchoProgress()
+    start = time.monotonic()
+    attempts = 0
+    target_url = url
+    body = None
+    latency = None
+    ttfb = None
+    while True:
+        if attempts > 0:
+            progress.retry(file, target_url, attempts)
+            # Back off without blocking the event loop, so the other in-flight downloads keep going
+            await policy.wait_async(attempts)
+        attempts += 1
+        try:
+            generation = await primer.prime(session)
+            if bucket is not None:
+                await bucket.wait_async()
+            sent = time.monotonic()
+            async with session.get(url, params=params) as resp:
+                ttfb = time.monotonic() - sent
+                target_url = resp.url
+                head = await _read_head(resp.content)
+                outcome = classify(head, resp.status)
+                if outcome == SAVED and save:
+                    body = await _save(file, head, resp.content, store, also)
+            latency = time.monotonic() - sent
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            # Timeouts are not ClientErrors, but are retried like any other network failure
+            progress.network_error(target_url, e)
+            outcome = NETWORK_ERROR
+        if outcome == BAD_RESPONSE:
+            # An HTML page in place of the csv usually means the SAS session expired
+            primer.expire(generation)
+        if outcome in (SAVED, NO_RESULTS) or not policy.allow(attempts):
+            break
+    result = make_result(outcome, attempts, start, latency, ttfb, body)
+    progress.finished(file, target_url, result, save)
+    return result
+
+
+async def _worker(queue, session, primer, policy, limiter, bucket, save, journal, metrics, progress, store):
+    while True:
+        t = await queue.get()
+        await limiter.acquire()
+        result = {'status': NETWORK_ERROR}
+        try:
+            result = await get_report(session, primer, policy, t['url'], t['param'], t['filename'], save, bucket,
+                                      progress, store, t.get('also', ()))
+            if journal is not None and save:
+                journal.record(t, result)
+            if metrics is not None:
+                metrics.record(t, result)
+        except Exception as e:
+            progress.failed(t['filename'], e)
+        finally:
+            await limiter.release(result)
+            queue.task_done()
+
+
+async def fetch_targets(targets, save=True, base_url=BASE_URL, limiter=None, retry_policy=None,
+                        journal=None, resume=False, bucket=None, metrics=None, progress=None, store=None,
+                        **pool_options):
+    """Download every target over a single pooled session that is primed once up front.
+
+    Targets are fed through one bounded work queue drained by a worker per slot of the limiter's
+    ceiling, so the targets can come from any number of datasets without the pool ever draining in
+    between. The limiter decides how many of those workers may have a request in flight, and
+    `bucket`, when given, caps the request rate.
+    Results are recorded in `journal` when one is given; with `resume`, targets the journal
+    already has are skipped. Every finished target is also handed to `metrics`, when given, and
+    reported to `progress`, which defaults to a line per event. Saved bodies are de-duplicated into
+    `store` when one is given.
+    """
+    if journal is not None and resume:
+        targets = journal.pending(targets)
+    progress = progress or EchoProgress()
+    limiter = limiter or AdaptiveLimiter(initial=CONCURRENCY, on_change=progress.limit_changed)
+    pool_options.setdefault('limit_per_host', limiter.ceiling)
+    primer = AsyncSessionPrimer(base_url)
+    policy = retry_policy or RetryPolicy()
+    queue = asyncio.Queue(maxsize=limiter.ceiling * 2)
+    async with build_session(**pool_options) as session:
+        workers = [asyncio.ensure_future(_worker(queue, session, primer, policy, limiter, bucket, save, journal,
+                                                   metrics, progress, store))
+                   for _ in range(limiter.ceiling)]
+        try:
+            for t in targets:
+                await queue.put(t)
+            await queue.join()
+        finally:
+            # Also when planning fails partway through: stop the workers, and with them any download
+            # still in flight, rather than leaving their tasks pending on the loop
+            for w in workers:
+                w.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+
+def fetch_async(dataset, output_dir, geography, catalog, save=True, base_url=BASE_URL, compression=None, **options):
+    targets = _iter_download_targets(dataset, output_dir, geography, catalog, compression)
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(fetch_targets(targets, save, base_url, **options))
+
+
+def fetch_catalog_async(jobs, catalog, save=True, base_url=BASE_URL, compression=None, **options):
+    """Download every (dataset, output_dir, geography) job in `jobs` on one event loop and one work queue."""
+    targets = _setup_catalog_targets(jobs, catalog, compression)
     loop = asyncio.get_event_loop()
-    loop.run_until_complete(
-        asyncio.gather(
-            *(get_report(t['url'], t['param'], t['filename'], save) for t in targets)
-        )
-    )
+    loop.run_until_complete(fetch_targets(targets, save, base_url, **options))
@@ -14,63 +14,183 @@
 #     You should have received a copy of the GNU General Public License
 #     along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
-import os
+import time
+import threading
 import urllib
-import click
 import requests
-import progressbar
-import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from requests.adapters import HTTPAdapter
 
-from .helpers import _setup_download_targets
+from .helpers import _iter_download_targets, _setup_catalog_targets
+from .output import CHUNK_SIZE, saving
+from .progress import EchoProgress
+from .responses import SAVED, NO_RESULTS, BAD_RESPONSE, NETWORK_ERROR, classify, make_result
+from .retry import RetryPolicy
+from .session import BASE_URL, SNIFF_SIZE, TIMEOUT, SessionPrimer
 
-BASE_URL = 'http://edsight.ct.gov/SASPortal/main.do'
+# Worker threads for the threaded mode, which needs nothing beyond requests
+THREADS = 10
 
 
-def fetch_sync(dataset, output_dir, geography, catalog, save=True):
-    """Download the csv file of the dataset to a target directory."""
-    targets = _setup_download_targets(dataset, output_dir, geography, catalog)
-    with requests.session() as s:
-        s.get(BASE_URL)
-
-        click.echo("Fetching {}\n\n".format(dataset))
-        # with progressbar.ProgressBar(max_value=len(targets)) as bar:
-        for i, t in enumerate(targets):
-            # bar.update(i)
-            # target_url_query = urllib.parse.urlencode(t['param']).replace('%2F', '/')
-
-            # click.echo("\n\nDownloading: {}\nFrom: {}?{}".format(os.path.basename(t['filename']),
-            #                                                         t['url'],target_url_query))
-
-            ATTEMPTS = 0
-            STATUS_CODE = 0
-            data = '<html>'
-            target_url = ''
-            while ATTEMPTS < 4 and STATUS_CODE != 200 and data.find('<html>') != -1:
-                if ATTEMPTS > 0:
-                    click.echo("Try #{} for fetching {}".format(ATTEMPTS, target_url))
-                    time.sleep(.75)
-                try:
-                    response = s.get(t['url'], params=t['param'])
-                except Exception as e:
-                    click.echo(e)
-                    STATUS_CODE = 0
-                    continue
-                STATUS_CODE = response.status_code
-                data = response.text
+def _read_head(chunks):
+    """Pull chunks off the body until there is enough of it to classify."""
+    head = b''
+    for chunk in chunks:
+        head += chunk
+        if len(head) >= SNIFF_SIZE:
+            break
+    return head
+
+
+def _save(file, head, chunks, store=None, also=()):
+    with saving(file, store, also) as (part, body):
+        with open(part, 'wb') as f:
+            f.write(body.feed(head))
+            for chunk in chunks:
+                f.write(body.feed(chunk))
+            f.write(body.finish())
+    return body
+
+
+def get_report(s, primer, policy, url, params, file, save, bucket=None, progress=None, store=None, also=(),
+               timeout=TIMEOUT):
+    """Fetch one export, streaming the body to `file` once its first chunk checks out.
+
+    `timeout` is the (connect, read) timeout of each attempt; running into it counts as a network error.
+    """
+    progress = progress or EchoProgress()
+    start = time.monotonic()
+    attempts = 0
+    target_url = url
+    body = None
+    latency = None
+    ttfb = None
+    while True:
+        if attempts > 0:
+            progress.retry(file, target_url, attempts)
+            policy.wait(attempts)
+        attempts += 1
+        try:
+            primer.prime(s)
+            if bucket is not None:
+                bucket.wait()
+            sent = time.monotonic()
+            with s.get(url, params=params, stream=True, timeout=timeout) as response:
+                ttfb = time.monotonic() - sent
                 target_url = response.url
-            if save and STATUS_CODE == 200:
-                # Lets check to make sure that the content is an actual CSV files with results
-                no_results = data.find('The query you have run did not contain any results.') != -1
-                bad_response = data.find('<html>') != -1
-                if not no_results and not bad_response:
-                    with open(t['filename'], 'wb') as file:
-                        file.write(response.content)
-                        click.echo('Saving {} on try: {}\n'.format(os.path.basename(t['filename']), ATTEMPTS+1))
-                elif no_results:
-                    click.echo("\n{} failed.\nThe query you have run did not contain any results.\n".format(target_url))
-                elif bad_response:
-                    click.echo("\n{} failed.\bBad response from the EdSight server.\n".format(target_url))
-                else:
-                    click.echo("\n{} failed.\bSomething unexpected happened.".format(target_url))
-            else:
-                click.echo("We had an issue with this dataset. Please try again.")
+                chunks = response.iter_content(CHUNK_SIZE)
+                head = _read_head(chunks)
+                outcome = classify(head, response.status_code)
+                if outcome == SAVED and save:
+                    body = _save(file, head, chunks, store, also)
+            latency = time.monotonic() - sent
+        except requests.RequestException as e:
+            progress.network_error(target_url, e)
+            outcome = NETWORK_ERROR
+        if outcome == BAD_RESPONSE:
+            # An HTML page in place of the csv usually means the SAS session expired
+            primer.expire()
+        if outcome in (SAVED, NO_RESULTS) or not policy.allow(attempts):
+            break
+    result = make_result(outcome, attempts, start, latency, ttfb, body)
+    progress.finished(file, target_url, result, save)
+    return result
+
+
+def fetch_targets_sync(targets, save=True, base_url=BASE_URL, retry_policy=None, journal=None, resume=False,
+                       bucket=None, metrics=None, progress=None, store=None, timeout=TIMEOUT):
+    """Download targets one after another over a single session.
+
+    Results are recorded in `journal` when one is given; with `resume`, targets the journal already
+    has are skipped. `bucket`, when given, caps the request rate. Every finished target is also handed
+    to `metrics`, when given, and reported to `progress`, which defaults to a line per event. Saved
+    bodies are de-duplicated into `store` when one is given. `timeout` bounds each request (see `get_report`).
+    """
+    if journal is not None and resume:
+        targets = journal.pending(targets)
+    primer = SessionPrimer(base_url, timeout)
+    policy = retry_policy or RetryPolicy()
+    progress = progress or EchoProgress()
+    with requests.session() as s:
+        # get_report primes the session on the first request, where a failure to prime is retried
+        for t in targets:
+            result = get_report(s, primer, policy, t['url'], t['param'], t['filename'], save, bucket, progress,
+                                store, t.get('also', ()), timeout)
+            if journal is not None and save:
+                journal.record(t, result)
+            if metrics is not None:
+                metrics.record(t, result)
+
+
+def fetch_sync(dataset, output_dir, geography, catalog, save=True, compression=None, **options):
+    """Download the csv file of the dataset to a target directory.
+
+    Files are compressed as they are written when a `compression` is given. See `fetch_targets_sync`
+    for the other options.
+    """
+    targets = _iter_download_targets(dataset, output_dir, geography, catalog, compression)
+    (options.get('progress') or EchoProgress()).note("Fetching {}\n\n".format(dataset))
+    fetch_targets_sync(targets, save, **options)
+
+
+def fetch_catalog_sync(jobs, catalog, save=True, compression=None, **options):
+    """Download every (dataset, output_dir, geography) job in `jobs` one after another over one session."""
+    fetch_targets_sync(_setup_catalog_targets(jobs, catalog, compression), save, **options)
+
+
+def fetch_targets_threaded(targets, save=True, base_url=BASE_URL, threads=THREADS, retry_policy=None,
+                           journal=None, resume=False, bucket=None, metrics=None, progress=None, store=None,
+                           timeout=TIMEOUT):
+    """Download targets on a bounded pool of threads.
+
+    Each worker thread gets its own session, primed once, and all of them share one HTTPAdapter whose
+    connection pool is sized to the number of threads. Targets are submitted a few at a time, so a
+    lazily planned target list is never materialized up front.
+    """
+    if journal is not None and resume:
+        targets = journal.pending(targets)
+    policy = retry_policy or RetryPolicy()
+    progress = progress or EchoProgress()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=threads)
+    local = threading.local()
+    sessions = []
+
+    def work(t):
+        if not hasattr(local, 'session'):
+            local.session = requests.session()
+            local.session.mount('http://', adapter)
+            local.session.mount('https://', adapter)
+            local.primer = SessionPrimer(base_url, timeout)
+            sessions.append(local.session)
+        try:
+            result = get_report(local.session, local.primer, policy, t['url'], t['param'], t['filename'], save,
+                                bucket, progress, store, t.get('also', ()), timeout)
+            if journal is not None and save:
+                journal.record(t, result)
+            if metrics is not None:
+                metrics.record(t, result)
+        except Exception as e:
+            progress.failed(t['filename'], e)
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        in_flight = set()
+        for t in targets:
+            if len(in_flight) >= threads * 2:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            in_flight.add(executor.submit(work, t))
+        wait(in_flight)
+    for session in sessions:
+        session.close()
+    adapter.close()
+
+
+def fetch_threaded(dataset, output_dir, geography, catalog, save=True, compression=None, **options):
+    """Download the csv files of the dataset to a target directory on a pool of threads."""
+    targets = _iter_download_targets(dataset, output_dir, geography, catalog, compression)
+    (options.get('progress') or EchoProgress()).note("Fetching {}\n\n".format(dataset))
+    fetch_targets_threaded(targets, save, **options)
+
+
+def fetch_catalog_threaded(jobs, catalog, save=True, compression=None, **options):
+    """Download every (dataset, output_dir, geography) job in `jobs` on one shared pool of threads."""
+    fetch_targets_threaded(_setup_catalog_targets(jobs, catalog, compression), save, **options)
@@ -16,10 +16,13 @@
 #
 
 import os
+from functools import lru_cache
 from urllib.parse import urlparse, parse_qs
-from itertools import product
+from itertools import product, groupby
 from slugify import Slugify
 
+from .output import compressed_name
+
 custom_slugify = Slugify(to_lower=True)
 custom_slugify.safe_chars = '_'
 
@@ -29,7 +32,7 @@ HEADERS = {
                    'Chrome/45.0.2454.101 Safari/537.36'),
 }
 
-def _state_enrollment_url_list(output_dir):
+def _state_enrollment_url_list(output_dir, compression=None):
     """One off method for dealing with non-standard format of state-level enrollment data"""
     var_map = {
         '1': 'grade-by-gender',
@@ -48,7 +51,7 @@ def _state_enrollment_url_list(output_dir):
     for year in years:
         for key, val in var_map.items():
             url = f'http://edsight.ct.gov/SASStoredProcess/do?_program=/CTDOE/EdSight/Release/Reporting/Public/Reports/StoredProcesses//EnrollmentYearExport&_year={year}&_district=State+of+Connecticut&_school=+&_subgroup=+&display={key}'
-            filename = f'enrollment__{year}_{val}_ct.csv'
+            filename = compressed_name(f'enrollment__{year}_{val}_ct.csv', compression)
             full_output_path = os.path.join(os.path.abspath(output_dir), filename)
             urls.append({'url': url, 'param': {}, 'filename': full_output_path})
 
@@ -63,7 +66,7 @@ def _state_enrollment_url_list(output_dir):
 
     for group in trend_subgroups:
         url = f'http://edsight.ct.gov/SASStoredProcess/do?_program=/CTDOE/EdSight/Release/Reporting/Public/Reports/StoredProcesses//EnrollmentTrendExport&_year=Trend&_district=State+of+Connecticut&_school=+&_subgroup={group}'
-        filename = f'enrollment__trend_{group.lower().replace("+", "-")}_ct.csv'
+        filename = compressed_name(f'enrollment__trend_{group.lower().replace("+", "-")}_ct.csv', compression)
         full_output_path = os.path.join(os.path.abspath(output_dir), filename)
         urls.append({'url': url, 'param': {}, 'filename': full_output_path})
 
@@ -90,11 +93,11 @@ def _build_catalog_geo_list(catalog):
     return dirs
 
 
-def _build_params_list(dataset, base_qs, variables):
-    filters = list(product(*[f['options'] for f in dataset['filters'] if f['name'] in variables]))
+def _iter_params(dataset, base_qs, variables):
+    """Lazily yield the params for every combination of the given variables' options."""
+    options = [f['options'] for f in dataset['filters'] if f['name'] in variables]
     param_options = [f['xpath_id'] for f in dataset['filters'] if f['name'] in variables]
-    params = []
-    for i, f in enumerate(filters):
+    for f in product(*options):
         new_qs = {**base_qs}
         for idx, p in enumerate(param_options):
             # We use rstrip here b/c there is a lack of consistency within edsight for how params values
@@ -105,16 +108,40 @@ def _build_params_list(dataset, base_qs, variables):
         for k,v in new_qs.items():
             if not isinstance(v, str):
                 new_qs[k] = v[0]
-        params.append(new_qs)
-    return params
+        yield new_qs
+
+
+def _build_params_list(dataset, base_qs, variables):
+    return list(_iter_params(dataset, base_qs, variables))
 
 def _get_xpaths(filters, variables):
     return [f['xpath_id'] for f in filters if f['name'] in variables]
 
 
-def _build_url_list(params, xpaths, url, output_dir, dataset_name):
-    """Build up a list of target objects."""
-    targets = []
+@lru_cache(maxsize=4096)
+def _slug_part(value):
+    """The slug of one '_'-joined part of a filename, or None if slugging it alone would not match.
+
+    Slugging is local to each run of safe characters, so a part slugs the same inside the full
+    filename as on its own, unless it starts or ends with characters that get turned into a separator.
+    """
+    slug = custom_slugify(value)
+    if custom_slugify('a_{}_a'.format(value)) != 'a_{}_a'.format(slug):
+        return None
+    return slug
+
+
+def _slugify_filename(parts):
+    """custom_slugify('_'.join(parts)), from the cached slugs of each part whenever they compose."""
+    slugs = [_slug_part(part) for part in parts]
+    if None in slugs:
+        return custom_slugify('_'.join(parts))
+    return '_'.join(slugs)
+
+
+def _iter_url_list(params, xpaths, url, output_dir, dataset_name, compression=None):
+    """Lazily turn params into target objects. With a `compression`, filenames get its suffix, e.g. .csv.gz"""
+    output_dir = os.path.abspath(output_dir)
     for p in params:
         # In testing we have a basic param object, but in actual work it is more complex
         # and includes params that are only specific to the SAS stored procedure. We don't need
@@ -122,34 +149,58 @@ def _build_url_list(params, xpaths, url, output_dir, dataset_name):
         f = [p.get(v,'') for v in xpaths]
         if p['_district'] == 'State of Connecticut':
             f.append('ct')
-        filename_variables = '_'.join(f)
-        filename = "{}__{}".format(dataset_name, filename_variables)
-        slugged_filename = "{}.csv".format(custom_slugify(filename))
-        full_output_path = os.path.join(os.path.abspath(output_dir), slugged_filename)
-        targets.append({'url': url, 'param': p, 'filename': full_output_path})
+        # The dataset name and its variables are joined by '__', i.e. an empty part
+        slugged_filename = compressed_name("{}.csv".format(_slugify_filename([dataset_name, ''] + f)), compression)
+        full_output_path = os.path.join(output_dir, slugged_filename)
+        yield {'url': url, 'param': p, 'filename': full_output_path}
 
     if dataset_name == 'Enrollment':
-        state_enrollment = _state_enrollment_url_list(output_dir)
-        targets.extend(state_enrollment)
+        for t in _state_enrollment_url_list(output_dir, compression):
+            yield t
 
-    return targets
 
-def _add_ct(param_list):
-    ct_list = []
-    for p in param_list:
+def _build_url_list(params, xpaths, url, output_dir, dataset_name, compression=None):
+    """Build up a list of target objects."""
+    return list(_iter_url_list(params, xpaths, url, output_dir, dataset_name, compression))
+
+
+def _param_key(params):
+    """Hashable, order-independent key for a param set."""
+    return tuple(sorted(params.items()))
+
+
+def _iter_add_ct(make_params):
+    """Lazily yield every param set, followed by the de-duplicated state-level copies.
+
+    `make_params` is called once per pass and must return a fresh iterable of the same params, so
+    that neither pass needs the full list in memory. State-level copies are de-duplicated on a
+    hashable key, in first-seen order.
+    """
+    for p in make_params():
+        yield p
+    seen = set()
+    for p in make_params():
         new = {**p}
         new['_district'] = 'State of Connecticut'
         if '_school' in new:
             new.__delitem__('_school')
-        if new not in ct_list:
-            ct_list.append(new)
-    return param_list + list(ct_list)
+        key = _param_key(new)
+        if key not in seen:
+            seen.add(key)
+            yield new
 
 
-def _setup_download_targets(dataset, output_dir, geography, catalog):
-    """Prepares a list of dictionaries which contain the components needed to generate a request and save results.
+def _add_ct(param_list):
+    return list(_iter_add_ct(lambda: param_list))
+
+
+def _iter_download_targets(dataset, output_dir, geography, catalog, compression=None):
+    """Lazily yields dictionaries which contain the components needed to generate a request and save results.
+
+     Every stage is a generator, so the first target is ready before the rest of the cartesian product of
+     options has been built.
      
-     Return object looks similar to this:
+     Yielded objects look similar to these:
      
      [{'url': 'http://edsight.ct.gov/do', 'param': {'_year': 'Trend', '_subgroup': 'All Students'},
         'filename': './test_Trend_All-Students.csv'},
@@ -179,11 +230,58 @@ def _setup_download_targets(dataset, output_dir, geography, catalog):
     # Call helper function to extract the correct xpaths from our lookup
     xpaths = _get_xpaths(ds_filters, variable)
 
-    # Build up a list params for each variable combo
-    params = _build_params_list(ds, qs, variable)
+    # Lazily build up params for each variable combo
+    params = _iter_params(ds, qs, variable)
     if dataset != 'Enrollment':
-        params = _add_ct(params)
-    # Return a list of objects that can be past to our http request
+        params = _iter_add_ct(lambda: _iter_params(ds, qs, variable))
+    # Yield objects that can be past to our http request
     # generator to build up a final url with params
 
-    return _build_url_list(params, xpaths, new_url, output_dir, dataset)
+    return _iter_url_list(params, xpaths, new_url, output_dir, dataset, compression)
+
+
+def _setup_download_targets(dataset, output_dir, geography, catalog, compression=None):
+    """Prepares a list of dictionaries which contain the components needed to generate a request and save results.
+
+    See `_iter_download_targets`, which this materializes.
+    """
+    return list(_iter_download_targets(dataset, output_dir, geography, catalog, compression))
+
+
+def _is_state_target(target):
+    # The one-off state enrollment targets carry their district in the url rather than the params
+    return (target['param'].get('_district') == 'State of Connecticut' or
+            '_district=State+of+Connecticut' in target['url'])
+
+
+def _iter_shared_targets(dataset, geographies, catalog, compression=None):
+    """Lazily yield the targets of one dataset for each (output_dir, geography) in `geographies`.
+
+    The state-level ("State of Connecticut") requests of the District and School geographies are identical
+    apart from the file they are saved to, so they are held back until every geography has been planned and
+    then yielded once each, with the filenames of the other geographies in `also`.
+    """
+    shared = {}
+    for output_dir, geography in geographies:
+        for t in _iter_download_targets(dataset, output_dir, geography, catalog, compression):
+            if not _is_state_target(t):
+                yield t
+                continue
+            key = (t['url'], _param_key(t['param']))
+            if key in shared:
+                shared[key].setdefault('also', []).append(t['filename'])
+            else:
+                shared[key] = t
+    for t in shared.values():
+        yield t
+
+
+def _setup_catalog_targets(jobs, catalog, compression=None):
+    """Chain the download targets of several (dataset, output_dir, geography) jobs into one stream.
+
+    State-level targets are shared between the jobs of a dataset, see `_iter_shared_targets`.
+    """
+    for dataset, dataset_jobs in groupby(jobs, key=lambda job: job[0]):
+        geographies = [(output_dir, geography) for _, output_dir, geography in dataset_jobs]
+        for t in _iter_shared_targets(dataset, geographies, catalog, compression):
+            yield t
@@ -0,0 +1,111 @@
+#     CT SDE EdSight Data Scraping Command Line Interface.
+#     Copyright (C) 2017  Sasha Cuerda, Connecticut Data Collaborative
+#
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from .output import find
+from .responses import SAVED, NO_RESULTS
+
+JOURNAL_NAME = '.edsight-journal.sqlite'
+
+# Outcomes that mean a target needs no further work
+DONE = (SAVED, NO_RESULTS)
+
+
+def target_key(url, params):
+    """Canonical identity of a request: the url plus its params in a stable order."""
+    return '{}?{}'.format(url, json.dumps(params, sort_keys=True))
+
+
+class Journal(object):
+    """Persistent per-target record of downloads, kept as a SQLite file in the output directory.
+
+    A row is written as soon as a target finishes, so an interrupted run can be resumed by fetching
+    only the targets that are missing or failed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS targets (
+                key TEXT NOT NULL,
+                filename TEXT NOT NULL,
+                url TEXT NOT NULL,
+                params TEXT NOT NULL,
+                status TEXT NOT NULL,
+                bytes INTEGER,
+                checksum TEXT,
+                attempts INTEGER,
+                elapsed REAL,
+                updated REAL,
+                PRIMARY KEY (key, filename)
+            )""")
+        self.conn.commit()
+
+    @classmethod
+    def for_directory(cls, output_dir):
+        return cls(os.path.join(output_dir, JOURNAL_NAME))
+
+    def get(self, target):
+        with self._lock:
+            row = self.conn.execute(
+                'SELECT status, bytes, checksum, attempts, elapsed FROM targets WHERE key = ? AND filename = ?',
+                (target_key(target['url'], target['param']), target['filename'])).fetchone()
+        if row is None:
+            return None
+        return dict(zip(('status', 'bytes', 'checksum', 'attempts', 'elapsed'), row))
+
+    def is_done(self, target):
+        return self.entry_done(target, self.get(target))
+
+    @staticmethod
+    def entry_done(target, entry):
+        """Whether `target` needs no further work, given its journal entry (None if it has none)."""
+        # A target shared between geographies is only done once its file is in every directory
+        present = all(find(f) is not None for f in [target['filename']] + target.get('also', []))
+        if entry is None:
+            # Files from runs that predate the journal count as done, compressed or not
+            return present
+        if entry['status'] == SAVED:
+            return present
+        return entry['status'] in DONE
+
+    def pending(self, targets):
+        """Only the targets that still need to be fetched."""
+        for t in targets:
+            if not self.is_done(t):
+                yield t
+
+    def record(self, target, result):
+        with self._lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO targets VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (target_key(target['url'], target['param']), target['filename'], target['url'],
+                 json.dumps(target['param'], sort_keys=True), result['status'], result.get('bytes'),
+                 result.get('checksum'), result.get('attempts'), result.get('elapsed'), time.time()))
+            self.conn.commit()
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,107 @@
+#     CT SDE EdSight Data Scraping Command Line Interface.
+#     Copyright (C) 2017  Sasha Cuerda, Connecticut Data Collaborative
+#
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import asyncio
+import time
+
+import click
+
+from .defaults import FLOOR, CEILING, INITIAL
+from .responses import SAVED, NO_RESULTS
+
+# A response slower than this multiple of the fastest recent (smoothed) latency counts as congestion
+LATENCY_TOLERANCE = 3.0
+
+
+def echo_limit(limit):
+    click.echo("Concurrency limit is now {}".format(limit))
+
+
+class AdaptiveLimiter(object):
+    """AIMD limit on the number of requests in flight.
+
+    The limit grows by one after a full window of healthy responses and is halved, never below
+    `floor`, when a response is bad, needed retries, or is much slower than the recent baseline.
+    Every change is kept in `history` as (seconds since start, limit) and passed to `on_change`.
+    """
+
+    def __init__(self, floor=FLOOR, ceiling=CEILING, initial=INITIAL, latency_tolerance=LATENCY_TOLERANCE,
+                 on_change=None):
+        if floor < 1 or ceiling < floor:
+            raise ValueError("Concurrency limits need 1 <= floor <= ceiling, got {} and {}".format(floor, ceiling))
+        self.floor = floor
+        self.ceiling = ceiling
+        self.limit = max(floor, min(ceiling, initial))
+        self.latency_tolerance = latency_tolerance
+        self.on_change = on_change
+        self.in_flight = 0
+        self.baseline = None
+        self.history = [(0.0, self.limit)]
+        self._start = time.monotonic()
+        self._healthy = 0
+        self._since_decrease = 0
+        self._cond = None
+
+    def _condition(self):
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+        return self._cond
+
+    async def acquire(self):
+        cond = self._condition()
+        async with cond:
+            await cond.wait_for(lambda: self.in_flight < self.limit)
+            self.in_flight += 1
+
+    async def release(self, result):
+        cond = self._condition()
+        async with cond:
+            self.in_flight -= 1
+            self.record(result)
+            cond.notify_all()
+
+    def record(self, result):
+        """Adjust the limit from one finished request's result."""
+        latency = result.get('latency')
+        congested = False
+        if latency is not None:
+            if self.baseline is None or latency < self.baseline:
+                self.baseline = latency
+            else:
+                # Let the baseline drift up slowly so one lucky fast response does not pin it forever
+                self.baseline += .01 * (latency - self.baseline)
+            congested = latency > self.baseline * self.latency_tolerance
+        healthy = result['status'] in (SAVED, NO_RESULTS) and result.get('attempts', 1) == 1 and not congested
+        self._since_decrease += 1
+        if healthy:
+            self._healthy += 1
+            if self._healthy >= self.limit:
+                self._healthy = 0
+                self._set(self.limit + 1)
+        elif self._since_decrease >= self.limit:
+            # Only back off once per window, so one burst of failures does not collapse the limit
+            self._healthy = 0
+            self._since_decrease = 0
+            self._set(self.limit // 2)
+
+    def _set(self, limit):
+        limit = max(self.floor, min(self.ceiling, limit))
+        if limit != self.limit:
+            self.limit = limit
+            self.history.append((time.monotonic() - self._start, limit))
+            if self.on_change is not None:
+                self.on_change(limit)
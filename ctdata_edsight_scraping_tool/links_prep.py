@@ -17,35 +17,55 @@
 
 import json
 import os
-from selenium import webdriver
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse, parse_qsl, urlencode, urljoin
+
+import click
+import requests
+from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+
+from .defaults import REBUILD_WORKERS, REBUILD_BACKEND
+from .session import BASE_URL, HEADERS, TIMEOUT, SessionPrimer
+
+# selenium is only needed by the browser backend, so it is imported when a browser is started.
+# This is the value of its By.XPATH.
+XPATH = 'xpath'
+
+CHROMEDRIVER = '/usr/local/bin/chromedriver'
+HOME_URL = 'http://edsight.ct.gov'
+
+# Reads every option of a select in one round trip, instead of one WebDriver call per <option>.
+# option.value falls back to the option's text when it has no value attribute, like get_attribute does.
+OPTIONS_SCRIPT = """
+var select = document.getElementsByName(arguments[0])[0];
+return Array.prototype.map.call(select.options, function (o) { return [o.value, o.text]; });
+"""
 
 
 def setup_chrome_browser():
     """Pass in configs to chrome browser"""
+    from selenium import webdriver
+    from selenium.webdriver.chrome.service import Service
     chromeOptions = webdriver.ChromeOptions()
+    chromeOptions.add_argument('--headless')
     # prefs = {"download.default_directory": DL_DIR}
     # chromeOptions.add_experimental_option("prefs", prefs)
-    chromedriver = '/usr/local/bin/chromedriver'
-    os.environ["webdriver.chrome.driver"] = chromedriver
-    browser = webdriver.Chrome(chromedriver, chrome_options=chromeOptions)
+    # Without a driver at the usual path, selenium looks one up itself
+    service = Service(CHROMEDRIVER) if os.path.exists(CHROMEDRIVER) else None
+    browser = webdriver.Chrome(service=service, options=chromeOptions)
     return browser
 
 def get_options(browser, name):
     """Does the actual work of getting the options and dropping empties"""
     do_not_keep = ['', '  ', '   ']
-    target = browser.find_element_by_xpath('//*[@name="{}"]'.format(name))
-    choices = target.find_elements_by_tag_name('option')
     results = []
-    for c in choices:
-        r = c.get_attribute('value')
-        if r not in do_not_keep and r is not None:
-            results.append(r)
-        else:
-            r = c.text
-            if r not in do_not_keep and r is not None:
-                results.append(r)
-            else:
-                pass
+    for value, text in browser.execute_script(OPTIONS_SCRIPT, name):
+        if value not in do_not_keep and value is not None:
+            results.append(value)
+        elif text not in do_not_keep and text is not None:
+            results.append(text)
     return results
 
 def build_variable_object(browser, variable):
@@ -53,13 +73,13 @@ def build_variable_object(browser, variable):
     name = variable['name']
     xpath_id = variable['xpath_id']
     if xpath_id == '_school':
-        browser.find_element_by_xpath('//option[contains(text(), "All Districts")]').click()
+        browser.find_element(XPATH, '//option[contains(text(), "All Districts")]').click()
     options = get_options(browser, xpath_id)
     return {'name': name, 'xpath_id': xpath_id, 'options': options}
 
 def get_download_link(browser):
     """After a page has been loaded, locate and return the download link."""
-    dl = browser.find_element_by_xpath(('//a[contains(text(), "Export .csv file")]'))
+    dl = browser.find_element(XPATH, '//a[contains(text(), "Export .csv file")]')
     return dl.get_attribute('href')
 
 
@@ -77,17 +97,130 @@ def scrape_dataset(browser, dataset):
         'filters': new_var_object
     }
 
-def build_links_object_json(links):
-    """Launch a chrome browser and kick off the scraping"""
-    browser = setup_chrome_browser()
-    browser.get('http://edsight.ct.gov')
-    links_object = {k:scrape_dataset(browser, v) for k,v in links.items() }
-    browser.quit()
-    return links_object
+def build_links_object_json(links, workers=REBUILD_WORKERS, make_browser=setup_chrome_browser):
+    """Spread the datasets over `workers` browsers, one per thread, and scrape them.
+
+    Each browser is started on its thread's first dataset and quit once every dataset is done. The
+    result keeps the order of `links`.
+    """
+    local = threading.local()
+    browsers = []
+    lock = threading.Lock()
+
+    def scrape(dataset):
+        if not hasattr(local, 'browser'):
+            local.browser = make_browser()
+            with lock:
+                browsers.append(local.browser)
+            local.browser.get(HOME_URL)
+        return scrape_dataset(local.browser, dataset)
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            scraped = list(executor.map(scrape, links.values()))
+    finally:
+        for browser in browsers:
+            browser.quit()
+    return dict(zip(links, scraped))
+
+def get_options_html(page, name):
+    """get_options for a parsed page: keep each option's value, or its text when the value is empty."""
+    do_not_keep = ['', '  ', '   ']
+    select = page.find('select', attrs={'name': name})
+    if select is None:
+        raise ValueError('No <select name="{}"> on the page'.format(name))
+    results = []
+    for o in select.find_all('option'):
+        # What option.value and option.text give in a browser
+        text = ' '.join(o.get_text().split())
+        value = o.get('value', text)
+        if value not in do_not_keep:
+            results.append(value)
+        elif text not in do_not_keep:
+            results.append(text)
+    return results
+
+def get_download_link_html(page, url):
+    """get_download_link for a parsed page fetched from `url`."""
+    dl = page.find('a', string=lambda s: s is not None and 'Export .csv file' in s)
+    if dl is None:
+        raise ValueError('No "Export .csv file" link on the page')
+    return urljoin(url, dl['href'])
+
+def _all_districts_url(url):
+    """The report url with All Districts picked, or None if that is already the report url."""
+    parsed = urlparse(url)
+    qs = parse_qsl(parsed.query, keep_blank_values=True)
+    if ('_district', 'All Districts') in qs:
+        return None
+    qs = [(k, v) for k, v in qs if k != '_district'] + [('_district', 'All Districts')]
+    return parsed._replace(query=urlencode(qs)).geturl()
+
+def scrape_dataset_http(session, dataset):
+    """scrape_dataset over plain HTTP: fetch the report page and parse its dropdowns and export link."""
+    click.echo(dataset['dataset'])
+
+    def fetch(url):
+        resp = session.get(url, timeout=TIMEOUT)
+        resp.raise_for_status()
+        return BeautifulSoup(resp.text, 'html.parser')
+
+    page = fetch(dataset['link'])
+    new_var_object = []
+    for v in dataset['filters']:
+        target = page
+        if v['xpath_id'] == '_school':
+            # The browser picks All Districts to list every school. Over HTTP that is another page,
+            # unless the report url already asks for All Districts.
+            url = _all_districts_url(dataset['link'])
+            if url is not None:
+                target = fetch(url)
+        try:
+            options = get_options_html(target, v['xpath_id'])
+        except ValueError as e:
+            raise ValueError('{}: {}'.format(dataset['dataset'], e))
+        new_var_object.append({'name': v['name'], 'xpath_id': v['xpath_id'], 'options': options})
+    return {
+        'dataset': dataset['dataset'],
+        'link': dataset['link'],
+        'download_link': get_download_link_html(page, dataset['link']),
+        'filters': new_var_object
+    }
+
+def build_links_object_http(links, workers=REBUILD_WORKERS, base_url=BASE_URL):
+    """build_links_object_json without a browser: fetch the report pages concurrently over pooled HTTP.
+
+    Like the threaded downloader, each worker thread gets its own session, primed once, and all of
+    them share one HTTPAdapter sized to the number of workers. The result keeps the order of `links`.
+    """
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+    local = threading.local()
+    sessions = []
+
+    def scrape(dataset):
+        if not hasattr(local, 'session'):
+            local.session = requests.session()
+            local.session.headers.update(HEADERS)
+            local.session.mount('http://', adapter)
+            local.session.mount('https://', adapter)
+            SessionPrimer(base_url).prime(local.session)
+            sessions.append(local.session)
+        return scrape_dataset_http(local.session, dataset)
 
-def rebuild(links, outfile):
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            scraped = list(executor.map(scrape, links.values()))
+    finally:
+        for session in sessions:
+            session.close()
+    return dict(zip(links, scraped))
+
+BACKENDS = {'browser': build_links_object_json, 'http': build_links_object_http}
+
+def rebuild(links, outfile, workers=REBUILD_WORKERS, backend=REBUILD_BACKEND, **options):
     """Take a file path name, rebuild the dataset manifest and write to the new file"""
-    new_links = build_links_object_json(links)
-    with open(outfile, 'w') as f:
+    new_links = BACKENDS[backend](links, workers, **options)
+    part = outfile + '.part'
+    with open(part, 'w') as f:
         json.dump(new_links, f)
-
+    os.replace(part, outfile)
@@ -0,0 +1,201 @@
+#     CT SDE EdSight Data Scraping Command Line Interface.
+#     Copyright (C) 2017  Sasha Cuerda, Connecticut Data Collaborative
+#
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import json
+import math
+import os
+import threading
+import time
+
+from .responses import SAVED, NO_RESULTS, BAD_RESPONSE, NETWORK_ERROR
+
+OUTCOMES = (SAVED, NO_RESULTS, BAD_RESPONSE, NETWORK_ERROR)
+QUANTILES = (.5, .95, .99)
+
+
+def percentile(values, q):
+    """Nearest-rank percentile of `values`, or None when there are none."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(q * len(ordered)) - 1)]
+
+
+def _summary(values):
+    summary = {'p{}'.format(int(q * 100)): percentile(values, q) for q in QUANTILES}
+    summary['mean'] = sum(values) / len(values) if values else None
+    return summary
+
+
+def _write_atomically(path, text):
+    # Collectors such as the node exporter's textfile collector may read the file at any moment
+    part = path + '.part'
+    with open(part, 'w') as f:
+        f.write(text)
+    os.replace(part, path)
+
+
+class _Series(object):
+    """Everything recorded for one dataset and geography."""
+
+    def __init__(self):
+        self.outcomes = dict.fromkeys(OUTCOMES, 0)
+        self.latency = []
+        self.ttfb = []
+        self.bytes = 0
+        self.attempts = 0
+        self.first = None
+        self.last = None
+
+    def add(self, result, finished):
+        status = result.get('status', NETWORK_ERROR)
+        self.outcomes[status] = self.outcomes.get(status, 0) + 1
+        self.attempts += result.get('attempts') or 1
+        self.bytes += result.get('bytes') or 0
+        if result.get('latency') is not None:
+            self.latency.append(result['latency'])
+        if result.get('ttfb') is not None:
+            self.ttfb.append(result['ttfb'])
+        started = finished - (result.get('elapsed') or 0)
+        self.first = started if self.first is None else min(self.first, started)
+        self.last = finished if self.last is None else max(self.last, finished)
+
+    def report(self):
+        requests = sum(self.outcomes.values())
+        window = (self.last - self.first) if requests else 0
+        return {
+            'requests': requests,
+            'outcomes': dict(self.outcomes),
+            'attempts': self.attempts,
+            'retries': self.attempts - requests,
+            'bytes': self.bytes,
+            'latency': _summary(self.latency),
+            'ttfb': _summary(self.ttfb),
+            'latency_sum': sum(self.latency),
+            'ttfb_sum': sum(self.ttfb),
+            'latency_count': len(self.latency),
+            'ttfb_count': len(self.ttfb),
+            'seconds': window,
+            'requests_per_second': requests / window if window else None,
+            'bytes_per_second': self.bytes / window if window else None,
+        }
+
+
+class RunMetrics(object):
+    """Per-request latency, time to first byte, size, attempts and outcome for a whole run.
+
+    Both fetchers hand every finished target to `record`. Results are grouped by the dataset and
+    geography registered with `add_job` for the target's output directory, or by the directory's name
+    when none was registered. `limit_history`, when set, holds the async downloader's concurrency
+    limit changes as (seconds since start, limit).
+    """
+
+    def __init__(self):
+        self.labels = {}
+        self.series = {}
+        self.limit_history = None
+        self.started = time.time()
+        self.finished = None
+        self._lock = threading.Lock()
+
+    def add_job(self, dataset, output_dir, geography):
+        self.labels[os.path.abspath(output_dir)] = "{} ({})".format(dataset, geography)
+
+    def label(self, target):
+        directory = os.path.dirname(os.path.abspath(target['filename']))
+        return self.labels.get(directory) or os.path.basename(directory)
+
+    def record(self, target, result):
+        label = self.label(target)
+        with self._lock:
+            if label not in self.series:
+                self.series[label] = _Series()
+            self.series[label].add(result, time.time())
+
+    def report(self):
+        self.finished = self.finished or time.time()
+        datasets = {label: series.report() for label, series in sorted(self.series.items())}
+        return {
+            'started': self.started,
+            'finished': self.finished,
+            'seconds': self.finished - self.started,
+            'requests': sum(d['requests'] for d in datasets.values()),
+            'bytes': sum(d['bytes'] for d in datasets.values()),
+            'latency': _summary([v for series in self.series.values() for v in series.latency]),
+            'datasets': datasets,
+            'concurrency_limit': [{'seconds': seconds, 'limit': limit}
+                                  for seconds, limit in self.limit_history or ()],
+        }
+
+    def write_json(self, path):
+        _write_atomically(path, json.dumps(self.report(), indent=2, sort_keys=True))
+
+    def write_prometheus(self, path):
+        """Write the run in the Prometheus text exposition format, for the node exporter's textfile collector."""
+        report = self.report()
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append('# HELP edsight_{} {}'.format(name, help_text))
+            lines.append('# TYPE edsight_{} {}'.format(name, kind))
+            for suffix, labels, value in samples:
+                if value is None:
+                    continue
+                label_text = ','.join('{}="{}"'.format(k, _escape(v)) for k, v in labels)
+                if label_text:
+                    label_text = '{' + label_text + '}'
+                lines.append('edsight_{}{}{} {}'.format(name, suffix, label_text, _number(value)))
+
+        datasets = report['datasets'].items()
+        metric('requests_total', 'counter', 'Export requests by dataset and outcome.',
+               [('', [('dataset', d), ('outcome', o)], n) for d, r in datasets for o, n in r['outcomes'].items()])
+        metric('attempts_total', 'counter', 'Attempts made, including retries.',
+               [('', [('dataset', d)], r['attempts']) for d, r in datasets])
+        metric('bytes_total', 'counter', 'Bytes of csv saved.',
+               [('', [('dataset', d)], r['bytes']) for d, r in datasets])
+        summaries = (
+            ('request_latency_seconds', 'latency', 'Time from sending a request to the end of its body.'),
+            ('time_to_first_byte_seconds', 'ttfb', 'Time from sending a request to its response headers.'),
+        )
+        for name, key, help_text in summaries:
+            samples = []
+            for d, r in datasets:
+                for q in QUANTILES:
+                    samples.append(('', [('dataset', d), ('quantile', str(q))], r[key]['p{}'.format(int(q * 100))]))
+                samples.append(('_sum', [('dataset', d)], r[key + '_sum']))
+                samples.append(('_count', [('dataset', d)], r[key + '_count']))
+            metric(name, 'summary', help_text, samples)
+        metric('throughput_requests_per_second', 'gauge', 'Requests completed per second while fetching the dataset.',
+               [('', [('dataset', d)], r['requests_per_second']) for d, r in datasets])
+        metric('throughput_bytes_per_second', 'gauge', 'Bytes saved per second while fetching the dataset.',
+               [('', [('dataset', d)], r['bytes_per_second']) for d, r in datasets])
+        if report['concurrency_limit']:
+            metric('concurrency_limit', 'gauge', 'Concurrency limit of the async downloader when the run finished.',
+                   [('', [], report['concurrency_limit'][-1]['limit'])])
+            metric('concurrency_limit_changes_total', 'counter', 'Times the concurrency limit was raised or lowered.',
+                   [('', [], len(report['concurrency_limit']) - 1)])
+        metric('run_finished_timestamp_seconds', 'gauge', 'When the run finished.',
+               [('', [], report['finished'])])
+        _write_atomically(path, '\n'.join(lines) + '\n')
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
@@ -0,0 +1,207 @@
+#     CT SDE EdSight Data Scraping Command Line Interface.
+#     Copyright (C) 2017  Sasha Cuerda, Connecticut Data Collaborative
+#
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import codecs
+import gzip
+import hashlib
+import io
+import os
+import shutil
+import zlib
+from contextlib import contextmanager
+
+# Export bodies are streamed to disk in chunks of this size, so memory use does not grow with file size.
+CHUNK_SIZE = 64 * 1024
+
+# File name suffix for each --compress option
+COMPRESSION_SUFFIXES = {'gzip': '.gz', 'zstd': '.zst'}
+
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+
+def compressed_name(filename, compression=None):
+    return filename + COMPRESSION_SUFFIXES[compression] if compression else filename
+
+
+def compression_of(filename):
+    """The compression a target file is written with, judged from its suffix, or None."""
+    for compression, suffix in COMPRESSION_SUFFIXES.items():
+        if filename.endswith(suffix):
+            return compression
+    return None
+
+
+def find(filename):
+    """The path of `filename` on disk, plain or under any compression, or None when there is none.
+
+    A file fetched with --compress counts as present for a later run without it, and the other way round.
+    """
+    compression = compression_of(filename)
+    base = filename[:-len(COMPRESSION_SUFFIXES[compression])] if compression else filename
+    for candidate in [filename, base] + [base + s for s in COMPRESSION_SUFFIXES.values()]:
+        if os.path.exists(candidate):
+            return candidate
+    return None
+
+
+def _gzip_compressor():
+    # wbits=31 writes a gzip container; zlib leaves the header mtime at 0, so equal bodies compress to equal bytes
+    return zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+
+
+def _zstd_compressor():
+    import zstandard
+    return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+
+
+COMPRESSORS = {'gzip': _gzip_compressor, 'zstd': _zstd_compressor}
+
+
+def _cp1252_fallback(error):
+    """Decode the bytes that are not valid UTF-8 as cp1252, which older EdSight exports are in."""
+    return error.object[error.start:error.end].decode('cp1252', errors='replace'), error.end
+
+
+codecs.register_error('edsight-cp1252', _cp1252_fallback)
+
+
+def open_text(filename):
+    """Open a target file, plain or compressed according to its suffix, as a stream of csv text.
+
+    Nothing is decompressed or decoded ahead of what is read, so reading the header of a large file
+    costs one line.
+    """
+    compression = compression_of(filename)
+    if compression == 'gzip':
+        raw = gzip.open(filename, 'rb')
+    elif compression == 'zstd':
+        import zstandard
+        raw = zstandard.ZstdDecompressor().stream_reader(open(filename, 'rb'), closefd=True)
+    else:
+        raw = open(filename, 'rb')
+    return io.TextIOWrapper(raw, encoding='utf-8-sig', errors='edsight-cp1252', newline='')
+
+
+def part_path(filename):
+    """Bodies are written next to their final name and only moved into place once complete."""
+    return filename + '.part'
+
+
+def finalize(part, filename):
+    os.replace(part, filename)
+
+
+def discard(part):
+    try:
+        os.remove(part)
+    except FileNotFoundError:
+        pass
+
+
+# ioctl that asks Linux filesystems such as btrfs and XFS for a copy-on-write clone of a file
+FICLONE = 0x40049409
+
+
+def _reflink(src, dst):
+    import fcntl
+    with open(src, 'rb') as s, open(dst, 'wb') as d:
+        fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+
+
+def _link(src, dst):
+    try:
+        os.link(src, dst)
+        return True
+    except OSError:
+        return False
+
+
+def _clone(src, dst):
+    try:
+        _reflink(src, dst)
+    except (OSError, ImportError):
+        shutil.copyfile(src, dst)
+
+
+def place(src, filename, link=True):
+    """Make `filename` a hardlink to `src`, or else a reflink, or else a copy. Swapped in atomically.
+
+    With `link=False` no hardlink is made, so the two files never share edits.
+    """
+    tmp = filename + '.link'
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    if not (link and _link(src, tmp)):
+        _clone(src, tmp)
+    os.replace(tmp, filename)
+
+
+class Body(object):
+    """Tracks the size and checksum of an export body as it is streamed to disk.
+
+    With a `compression`, chunks come back compressed, and `finish` returns whatever the compressor
+    still holds. Size and checksum are always of the csv itself.
+    """
+
+    def __init__(self, compression=None):
+        self.bytes = 0
+        self._hash = hashlib.sha256()
+        self._compressor = COMPRESSORS[compression]() if compression else None
+
+    @classmethod
+    def for_file(cls, filename):
+        return cls(compression_of(filename))
+
+    def feed(self, chunk):
+        self.bytes += len(chunk)
+        self._hash.update(chunk)
+        if self._compressor is not None:
+            return self._compressor.compress(chunk)
+        return chunk
+
+    def finish(self):
+        if self._compressor is not None:
+            return self._compressor.flush()
+        return b''
+
+    @property
+    def checksum(self):
+        return self._hash.hexdigest()
+
+
+@contextmanager
+def saving(file, store=None, also=()):
+    """Write an export body for `file` to its part file, then put it in place, or discard it on failure.
+
+    Yields the part path and a Body to feed each chunk through. Once the block finishes, the body is
+    moved into `store` when one is given, or else to `file`, and `file` is placed at every name in
+    `also`, the same export planned for another geography's directory.
+    """
+    part = part_path(file)
+    body = Body.for_file(file)
+    try:
+        yield part, body
+        if store is not None:
+            store.put(part, body.checksum, file)
+        else:
+            finalize(part, file)
+        for f in also:
+            place(file, f, link=store is not None)
+    except BaseException:
+        discard(part)
+        raise
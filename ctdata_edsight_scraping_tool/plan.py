@@ -0,0 +1,75 @@
+#     CT SDE EdSight Data Scraping Command Line Interface.
+#     Copyright (C) 2017  Sasha Cuerda, Connecticut Data Collaborative
+#
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+
+from .helpers import _iter_shared_targets
+from .journal import Journal, JOURNAL_NAME
+
+# Seconds per export assumed when there is no latency history to go on
+DEFAULT_LATENCY = 2.0
+
+
+def open_journal(output_dir):
+    """The journal of an earlier run into `output_dir`, or None. Planning never creates one."""
+    path = os.path.join(output_dir, JOURNAL_NAME)
+    return Journal(path) if os.path.exists(path) else None
+
+
+def plan_dataset(dataset, geographies, catalog, journal=None):
+    """Count the targets of a dataset for each (output_dir, geography) in `geographies`.
+
+    Each geography's plan has its number of files, the requests needed for them, how many of those
+    requests are already done, and the latency history of the done ones. State-level requests shared
+    between geographies are counted once, against the first geography. Nothing is requested from EdSight.
+    """
+    plans = {}
+    for output_dir, geography in geographies:
+        plans[os.path.abspath(output_dir)] = {'dataset': dataset, 'geography': geography, 'files': 0,
+                                              'targets': 0, 'done': 0, 'timed': 0, 'elapsed': 0.0}
+    for t in _iter_shared_targets(dataset, geographies, catalog):
+        plan = plans[os.path.dirname(t['filename'])]
+        plan['targets'] += 1
+        entry = journal.get(t) if journal is not None else None
+        if Journal.entry_done(t, entry):
+            plan['done'] += 1
+        if entry is not None and entry['elapsed']:
+            plan['timed'] += 1
+            plan['elapsed'] += entry['elapsed']
+        for filename in [t['filename']] + t.get('also', []):
+            plans[os.path.dirname(filename)]['files'] += 1
+    for plan in plans.values():
+        plan['remaining'] = plan['targets'] - plan['done']
+    return list(plans.values())
+
+
+def estimate_seconds(plans, concurrency, rate=None):
+    """Fill in each plan's latency and estimated wall-clock seconds, and return the total.
+
+    A dataset's own latency history is used when it has some, then the average over every dataset
+    with history, then DEFAULT_LATENCY. The estimate is never faster than `rate` requests per second.
+    """
+    timed = sum(p['timed'] for p in plans)
+    overall = sum(p['elapsed'] for p in plans) / timed if timed else DEFAULT_LATENCY
+    total = 0.0
+    for p in plans:
+        p['latency'] = p['elapsed'] / p['timed'] if p['timed'] else overall
+        p['seconds'] = p['remaining'] * p['latency'] / concurrency
+        if rate:
+            p['seconds'] = max(p['seconds'], p['remaining'] / rate)
+        total += p['seconds']
+    return total
@@ -0,0 +1,259 @@
+#     CT SDE EdSight Data Scraping Command Line Interface.
+#     Copyright (C) 2017  Sasha Cuerda, Connecticut Data Collaborative
+#
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import json
+import os
+import sys
+import threading
+import time
+
+import click
+
+from .limits import echo_limit
+from .responses import SAVED, NO_RESULTS, echo_outcome
+
+MODES = ('bar', 'log', 'quiet', 'jsonl')
+
+# Seconds between refreshes of the live display
+INTERVAL = .5
+
+# Weight of the latest interval in the smoothed rates
+SMOOTHING = .3
+
+BAR_WIDTH = 24
+
+
+class EchoProgress(object):
+    """Reports a run one line per event: every save, retry and failure. The original, chatty output.
+
+    This is also the interface every progress display implements; both fetchers call these methods
+    and nothing else for their output.
+    """
+
+    def __init__(self, total=None):
+        self.total = total
+
+    def start(self):
+        return self
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def note(self, text):
+        click.echo(text)
+
+    def retry(self, file, target_url, attempts):
+        click.echo("Try #{} for fetching {}".format(attempts + 1, target_url))
+
+    def network_error(self, target_url, error):
+        click.echo("\n{} failed.\n{}\n".format(target_url, error))
+
+    def limit_changed(self, limit):
+        echo_limit(limit)
+
+    def finished(self, file, target_url, result, save=True):
+        if save or result['status'] != SAVED:
+            echo_outcome(result['status'], file, target_url, result['attempts'])
+
+    def failed(self, file, error):
+        click.echo("\n{} failed.\n{}\n".format(file, error))
+
+
+class Progress(EchoProgress):
+    """One live display for a whole run, refreshed at a fixed rate from a background thread.
+
+    Events only update counters, so the cost of reporting no longer grows with the number of files.
+    `mode` is 'bar' for a single status line on stderr, 'quiet' for nothing but failures and a final
+    summary, or 'jsonl' for one JSON object per refresh and per failure on stdout, for cron and log
+    shippers.
+    """
+
+    def __init__(self, total=None, mode='bar', interval=INTERVAL, stream=None):
+        super(Progress, self).__init__(total)
+        self.mode = mode
+        self.interval = interval
+        self.stream = stream or (sys.stderr if mode == 'bar' else sys.stdout)
+        self.completed = 0
+        self.failures = 0
+        self.bytes = 0
+        self.retrying = set()
+        self.limit = None
+        self.request_rate = None
+        self.byte_rate = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._started = None
+        self._last = None
+        self._width = 0
+
+    def start(self):
+        self._started = self._last = (time.monotonic(), 0, 0)
+        if self.mode != 'quiet':
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        return self
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._tick()
+        status = self.status()
+        if self.mode == 'jsonl':
+            self._write_json(dict(status, event='done'))
+        else:
+            self._clear()
+            self._write("Fetched {completed} files ({failures} failed, {bytes} bytes) in {seconds:.0f}s".format(
+                **status))
+
+    def note(self, text):
+        pass
+
+    def retry(self, file, target_url, attempts):
+        with self._lock:
+            self.retrying.add(file)
+
+    def network_error(self, target_url, error):
+        pass
+
+    def limit_changed(self, limit):
+        self.limit = limit
+
+    def finished(self, file, target_url, result, save=True):
+        with self._lock:
+            self.completed += 1
+            self.bytes += result.get('bytes') or 0
+            self.retrying.discard(file)
+        if result['status'] not in (SAVED, NO_RESULTS):
+            self._failure(file, str(target_url), result['status'], attempts=result['attempts'])
+
+    def failed(self, file, error):
+        with self._lock:
+            self.completed += 1
+        self._failure(file, None, 'error', error=str(error))
+
+    def _failure(self, file, target_url, status, **details):
+        with self._lock:
+            self.failures += 1
+        if self.mode == 'jsonl':
+            self._write_json(dict(details, event='failed', file=file, url=target_url, status=status))
+        else:
+            self._clear()
+            self._write("{} failed: {}{}".format(os.path.basename(file), status,
+                                                ''.join(' ({})'.format(v) for v in details.values() if v)))
+            self._render()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._tick()
+            if self.mode == 'jsonl':
+                self._write_json(dict(self.status(), event='progress'))
+            else:
+                self._render()
+
+    def _tick(self):
+        """Fold the interval since the last tick into the smoothed rates."""
+        now = time.monotonic()
+        with self._lock:
+            completed, total_bytes = self.completed, self.bytes
+        then, last_completed, last_bytes = self._last
+        if now - then > 0:
+            rates = ((completed - last_completed) / (now - then), (total_bytes - last_bytes) / (now - then))
+            if self.request_rate is None:
+                self.request_rate, self.byte_rate = rates
+            else:
+                self.request_rate += SMOOTHING * (rates[0] - self.request_rate)
+                self.byte_rate += SMOOTHING * (rates[1] - self.byte_rate)
+        self._last = (now, completed, total_bytes)
+
+    def status(self):
+        remaining = self.total - self.completed if self.total is not None else None
+        eta = remaining / self.request_rate if remaining is not None and self.request_rate else None
+        return {
+            'completed': self.completed,
+            'total': self.total,
+            'failures': self.failures,
+            'bytes': self.bytes,
+            'retrying': len(self.retrying),
+            'limit': self.limit,
+            'requests_per_second': self.request_rate or 0.0,
+            'bytes_per_second': self.byte_rate or 0.0,
+            'eta': eta,
+            'seconds': time.monotonic() - self._started[0],
+        }
+
+    def _render(self):
+        if self.mode != 'bar' or self._started is None:
+            return
+        s = self.status()
+        if s['total']:
+            filled = int(BAR_WIDTH * min(1, s['completed'] / s['total']))
+            line = "[{}{}] {}/{}".format('#' * filled, ' ' * (BAR_WIDTH - filled), s['completed'], s['total'])
+        else:
+            line = "{} files".format(s['completed'])
+        line += " {:.1f} req/s {} {} retrying".format(s['requests_per_second'], _size(s['bytes_per_second']) + '/s',
+                                                       s['retrying'])
+        if s['limit'] is not None:
+            line += " limit {}".format(s['limit'])
+        if s['eta'] is not None:
+            line += " ETA {}".format(_duration(s['eta']))
+        with self._lock:
+            self.stream.write('\r' + line.ljust(self._width))
+            self.stream.flush()
+            self._width = len(line)
+
+    def _clear(self):
+        if self.mode == 'bar' and self._width:
+            with self._lock:
+                self.stream.write('\r' + ' ' * self._width + '\r')
+                self._width = 0
+
+    def _write(self, text):
+        with self._lock:
+            self.stream.write(text + '\n')
+            self.stream.flush()
+
+    def _write_json(self, obj):
+        self._write(json.dumps(obj, sort_keys=True))
+
+
+def make_progress(mode, total=None):
+    """The progress display for a --progress mode."""
+    if mode == 'log':
+        return EchoProgress(total)
+    return Progress(total, mode)
+
+
+def _size(n):
+    for unit in ('B', 'kB', 'MB', 'GB'):
+        if n < 1000:
+            return "{:.1f} {}".format(n, unit)
+        n /= 1000
+    return "{:.1f} TB".format(n)
+
+
+def _duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return "{}:{:02d}:{:02d}".format(hours, minutes, seconds)
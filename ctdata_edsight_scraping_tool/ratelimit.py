@@ -0,0 +1,88 @@
+#     CT SDE EdSight Data Scraping Command Line Interface.
+#     Copyright (C) 2017  Sasha Cuerda, Connecticut Data Collaborative
+#
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import asyncio
+import os
+import struct
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+_STATE = struct.Struct('<dd')
+
+
+class TokenBucket(object):
+    """Requests-per-second token bucket, optionally shared by every process using the same state file.
+
+    Taking a token never spins: a request that arrives when the bucket is empty reserves the next
+    free slot and is told how long to sleep. With `path`, the bucket state lives in that file under
+    an exclusive lock, so concurrent processes on one host draw from a single budget. Without it,
+    where file locking is not available, or when the file cannot be opened, the budget is per process.
+    """
+
+    def __init__(self, rate, burst=None, path=None):
+        if rate <= 0:
+            raise ValueError("Rate must be positive, got {}".format(rate))
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(1, rate))
+        self.path = path if fcntl is not None else None
+        self._lock = threading.Lock()
+        self._state = (self.burst, time.time())
+
+    def _reserve(self, state, now):
+        tokens, stamp = state
+        tokens = min(self.burst, tokens + max(0, now - stamp) * self.rate) - 1
+        return (tokens, now), max(0.0, -tokens / self.rate)
+
+    def take(self):
+        """Take a token and return how many seconds to wait before using it."""
+        with self._lock:
+            now = time.time()
+            fd = None
+            if self.path is not None:
+                try:
+                    fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o666)
+                except OSError:
+                    # e.g. a state file another user created: keep this process to its own budget
+                    self.path = None
+            if fd is None:
+                self._state, delay = self._reserve(self._state, now)
+                return delay
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                raw = os.read(fd, _STATE.size)
+                state = _STATE.unpack(raw) if len(raw) == _STATE.size else (self.burst, now)
+                state, delay = self._reserve(state, now)
+                os.lseek(fd, 0, os.SEEK_SET)
+                os.write(fd, _STATE.pack(*state))
+            finally:
+                os.close(fd)
+            return delay
+
+    def wait(self):
+        delay = self.take()
+        if delay:
+            time.sleep(delay)
+
+    async def wait_async(self):
+        delay = self.take()
+        if delay:
+            await asyncio.sleep(delay)
@@ -0,0 +1,76 @@
+#     CT SDE EdSight Data Scraping Command Line Interface.
+#     Copyright (C) 2017  Sasha Cuerda, Connecticut Data Collaborative
+#
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import time
+
+import click
+
+from .session import SNIFF_SIZE, session_expired
+
+# Outcomes of a single export request
+SAVED = 'saved'
+NO_RESULTS = 'no_results'
+BAD_RESPONSE = 'bad_response'
+NETWORK_ERROR = 'network_error'
+
+NO_RESULTS_MARKERS = (
+    'No Search Results',
+    'The query you have run did not contain any results.',
+)
+
+
+def classify(head, status=200):
+    """Decide from the first chunk of an export body whether it is a csv worth saving.
+
+    Only the head is inspected, so the rest of the body can be streamed straight to disk.
+    """
+    text = head[:SNIFF_SIZE].decode('latin-1')
+    if any(m in text for m in NO_RESULTS_MARKERS):
+        return NO_RESULTS
+    if status != 200 or '<head>' in text or session_expired(text):
+        return BAD_RESPONSE
+    return SAVED
+
+
+def make_result(outcome, attempts, start, latency=None, ttfb=None, body=None):
+    """What fetching one target came to, as recorded in the journal and the run metrics.
+
+    `start` is the time.monotonic() the first attempt was made at, and `body` the Body that was saved, if any.
+    """
+    return {
+        'status': outcome,
+        'attempts': attempts,
+        'elapsed': time.monotonic() - start,
+        'latency': latency,
+        'ttfb': ttfb,
+        'bytes': body.bytes if body else 0,
+        'checksum': body.checksum if body else None,
+    }
+
+
+def echo_outcome(outcome, file, target_url, attempts):
+    if outcome == SAVED:
+        click.echo('Saving {} on try: {}\n'.format(os.path.basename(file), attempts))
+    elif outcome == NO_RESULTS:
+        click.echo("\n{} failed.\nThe query you have run did not contain any results.\n".format(target_url))
+    elif outcome == BAD_RESPONSE:
+        click.echo("\n{} failed.\bBad response from the EdSight server.\n".format(target_url))
+    elif outcome == NETWORK_ERROR:
+        click.echo("\n{} failed.\bNo response from the EdSight server after {} tries.\n".format(target_url, attempts))
+    else:
+        click.echo("\n{} failed.\bSomething unexpected happened.".format(target_url))
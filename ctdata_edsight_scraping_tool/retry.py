@@ -0,0 +1,66 @@
+#     CT SDE EdSight Data Scraping Command Line Interface.
+#     Copyright (C) 2017  Sasha Cuerda, Connecticut Data Collaborative
+#
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import asyncio
+import random
+import threading
+import time
+
+from .defaults import MAX_ATTEMPTS, BASE_DELAY, MAX_DELAY
+
+
+class RetryPolicy(object):
+    """Exponential backoff with jitter, a per-target attempt cap and a retry budget for the whole run.
+
+    One policy is shared by every target of a run, so `budget` bounds the total number of retries
+    no matter how many targets are flaky. `budget=None` leaves it unbounded.
+    """
+
+    def __init__(self, max_attempts=MAX_ATTEMPTS, base_delay=BASE_DELAY, max_delay=MAX_DELAY,
+                 jitter=.5, budget=None):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.budget = budget
+        self.retries = 0
+        self._lock = threading.Lock()
+
+    @property
+    def exhausted(self):
+        return self.budget is not None and self.retries >= self.budget
+
+    def allow(self, attempts):
+        """Whether a target that has made `attempts` attempts may try again. Spends one retry."""
+        if attempts >= self.max_attempts:
+            return False
+        with self._lock:
+            if self.exhausted:
+                return False
+            self.retries += 1
+        return True
+
+    def delay(self, attempts):
+        """Seconds to back off after `attempts` attempts, with up to `jitter` of it randomly shaved off."""
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempts - 1))
+        return delay * (1 - self.jitter * random.random())
+
+    def wait(self, attempts):
+        time.sleep(self.delay(attempts))
+
+    async def wait_async(self, attempts):
+        await asyncio.sleep(self.delay(attempts))
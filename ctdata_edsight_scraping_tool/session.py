@@ -0,0 +1,92 @@
+#     CT SDE EdSight Data Scraping Command Line Interface.
+#     Copyright (C) 2017  Sasha Cuerda, Connecticut Data Collaborative
+#
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import asyncio
+
+from .defaults import CONNECT_TIMEOUT, READ_TIMEOUT
+
+BASE_URL = 'http://edsight.ct.gov/SASPortal/main.do'
+HEADERS = {
+    'user-agent': ('Mozilla/5.0 (Macintosh; Intel Mac OS X 10_10_5) '
+                   'AppleWebKit/537.36 (KHTML, like Gecko) '
+                   'Chrome/45.0.2454.101 Safari/537.36'),
+}
+
+# (connect, read) timeouts for requests
+TIMEOUT = (CONNECT_TIMEOUT, READ_TIMEOUT)
+
+# How much of the start of a response body we look at when deciding what came back.
+SNIFF_SIZE = 2048
+
+
+def session_expired(data):
+    """True when the export endpoint answered with an HTML page (login or error) instead of a csv.
+
+    That is what SASStoredProcess/do hands back once the portal cookie is missing or stale.
+    """
+    return '<html' in data[:SNIFF_SIZE].lower()
+
+
+class SessionPrimer(object):
+    """Fetch the portal cookie once for a requests session and again only after it expires."""
+
+    def __init__(self, base_url=BASE_URL, timeout=TIMEOUT):
+        self.base_url = base_url
+        self.timeout = timeout
+        self.primed = False
+        self.primes = 0
+
+    def prime(self, session):
+        if not self.primed:
+            session.get(self.base_url, timeout=self.timeout)
+            self.primed = True
+            self.primes += 1
+
+    def expire(self):
+        self.primed = False
+
+
+class AsyncSessionPrimer(object):
+    """Async counterpart of SessionPrimer, shared by every in-flight request on one aiohttp session.
+
+    Each priming bumps a generation counter. A request that sees an expired session reports the
+    generation it was sent under, so a burst of failures from one expiry only triggers one re-prime.
+    """
+
+    def __init__(self, base_url=BASE_URL):
+        self.base_url = base_url
+        self.primed = False
+        self.primes = 0
+        self.generation = 0
+        self._lock = None
+
+    async def prime(self, session):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        if not self.primed:
+            async with self._lock:
+                if not self.primed:
+                    async with session.get(self.base_url) as resp:
+                        await resp.read()
+                    self.generation += 1
+                    self.primes += 1
+                    self.primed = True
+        return self.generation
+
+    def expire(self, generation):
+        if generation == self.generation:
+            self.primed = False
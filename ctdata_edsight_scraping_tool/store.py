@@ -0,0 +1,74 @@
+#     CT SDE EdSight Data Scraping Command Line Interface.
+#     Copyright (C) 2017  Sasha Cuerda, Connecticut Data Collaborative
+#
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import threading
+
+from .output import COMPRESSION_SUFFIXES, compression_of, discard, place
+
+STORE_NAME = '.edsight-store'
+
+
+class Store(object):
+    """Content-addressed store of export bodies, kept under the output directory.
+
+    A body is stored once, as `<root>/ab/abcdef...` named after the sha256 of the csv (plus the
+    compression suffix, if any), and every target file with that content is a link to it. The layout
+    of the output directories does not change. Since the files are links, edit copies of them rather
+    than the files themselves.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.stored = 0
+        self.deduplicated = 0
+        self.bytes_saved = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def for_directory(cls, output_dir):
+        return cls(os.path.join(output_dir, STORE_NAME))
+
+    def path_for(self, checksum, compression=None):
+        name = checksum + (COMPRESSION_SUFFIXES[compression] if compression else '')
+        return os.path.join(self.root, checksum[:2], name)
+
+    def put(self, part, checksum, filename):
+        """Move the finished body at `part` into the store, unless it is already there, and link `filename` to it."""
+        obj = self.path_for(checksum, compression_of(filename))
+        os.makedirs(os.path.dirname(obj), exist_ok=True)
+        size = os.path.getsize(part)
+        try:
+            # Linking fails if the object exists, so of two workers with the same body only one stores it
+            os.link(part, obj)
+            stored = True
+        except FileExistsError:
+            stored = False
+        except OSError:
+            # No hardlinks on this filesystem: check and move under the lock instead
+            with self._lock:
+                stored = not os.path.exists(obj)
+                if stored:
+                    os.replace(part, obj)
+        discard(part)
+        with self._lock:
+            if stored:
+                self.stored += 1
+            else:
+                self.deduplicated += 1
+                self.bytes_saved += size
+        place(obj, filename)
@@ -14,14 +14,15 @@ INSTALL_REQUIRES = [
     'Click>=6.0',
     'Requests>=2.13.0',
     'beautifulsoup4>=4.5.3',
-    'progressbar2',
-    'selenium',
     'awesome-slugify',
     'boto'
 ]
 
 EXTRAS_REQUIRE = {
     # ...
+    'consolidate': ['pyarrow'],
+    'zstd': ['zstandard'],
+    'browser': ['selenium'],
 }
 
 if int(setuptools.__version__.split(".", 1)[0]) < 18:
@@ -8,6 +8,7 @@ test_ctdata_edsight_scraping_tool
 Tests for `ctdata_edsight_scraping_tool` module.
 """
 
+import os
 import pytest
 
 from contextlib import contextmanager
@@ -152,3 +153,939 @@ def test_setup_download_targets(simple_dataset):
 
     results = _setup_download_targets('test', './', ['Year', 'Filter By'], simple_dataset)
     assert results == targets
+
+
+def test_session_expired_detects_html_pages():
+    from ctdata_edsight_scraping_tool.session import session_expired
+    assert session_expired('<HTML><head><title>SAS Logon</title></head></HTML>')
+    assert not session_expired('District,Year,Count\nSome District,2015-16,100\n')
+
+
+def test_session_primer_only_reprimes_after_expiry():
+    from ctdata_edsight_scraping_tool.session import SessionPrimer
+
+    class FakeSession(object):
+        calls = 0
+
+        def get(self, url, timeout=None):
+            self.calls += 1
+            self.timeout = timeout
+
+    session = FakeSession()
+    primer = SessionPrimer('http://localhost/SASPortal/main.do', timeout=(1, 2))
+    for _ in range(5):
+        primer.prime(session)
+    assert session.calls == 1 and session.timeout == (1, 2)
+    primer.expire()
+    primer.prime(session)
+    assert session.calls == 2
+
+
+def test_async_session_primer_ignores_stale_expiry():
+    import asyncio
+    from ctdata_edsight_scraping_tool.session import AsyncSessionPrimer
+
+    class FakeResponse(object):
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, *args):
+            pass
+
+        async def read(self):
+            return b''
+
+    class FakeSession(object):
+        calls = 0
+
+        def get(self, url):
+            self.calls += 1
+            return FakeResponse()
+
+    async def run(session, primer):
+        generations = await asyncio.gather(*(primer.prime(session) for _ in range(10)))
+        primer.expire(generations[0])
+        primer.expire(generations[0])
+        await primer.prime(session)
+        # A failure reported under the old generation must not force another prime
+        primer.expire(generations[0])
+        await primer.prime(session)
+
+    session = FakeSession()
+    asyncio.get_event_loop().run_until_complete(run(session, AsyncSessionPrimer()))
+    assert session.calls == 2
+
+
+def test_setup_catalog_targets_chains_jobs_and_shares_state_targets(dataset):
+    from ctdata_edsight_scraping_tool.helpers import _setup_download_targets, _setup_catalog_targets
+    catalog = {'Chronic Absenteeism': dataset}
+    jobs = [('Chronic Absenteeism', './district', 'District'), ('Chronic Absenteeism', './school', 'School')]
+    district = _setup_download_targets('Chronic Absenteeism', './district', 'District', catalog)
+    school = _setup_download_targets('Chronic Absenteeism', './school', 'School', catalog)
+    state = [t for t in district if t['param']['_district'] == 'State of Connecticut']
+    school_state = [t for t in school if t['param']['_district'] == 'State of Connecticut']
+    assert [t['param'] for t in state] == [t['param'] for t in school_state]
+
+    targets = list(_setup_catalog_targets(jobs, catalog))
+    assert len(targets) == len(district) + len(school) - len(state)
+    assert targets[:len(district) - len(state)] == district[:len(district) - len(state)]
+    assert targets[-len(state):] == [dict(t, also=[s['filename']]) for t, s in zip(state, school_state)]
+
+
+def test_retry_policy_caps_attempts_and_budget():
+    from ctdata_edsight_scraping_tool.retry import RetryPolicy
+    policy = RetryPolicy(max_attempts=3, budget=3)
+    assert policy.allow(1)
+    assert policy.allow(2)
+    assert not policy.allow(3)
+    assert policy.allow(1)
+    assert not policy.allow(1)
+    assert policy.exhausted
+
+
+def test_retry_policy_backoff_grows_and_is_bounded():
+    from ctdata_edsight_scraping_tool.retry import RetryPolicy
+    policy = RetryPolicy(base_delay=1, max_delay=5, jitter=0)
+    assert [policy.delay(a) for a in range(1, 6)] == [1, 2, 4, 5, 5]
+    jittered = RetryPolicy(base_delay=1, jitter=.5)
+    assert all(.5 <= jittered.delay(1) <= 1 for _ in range(50))
+
+
+def test_classify_response_head():
+    from ctdata_edsight_scraping_tool.responses import SAVED, NO_RESULTS, BAD_RESPONSE, classify
+    assert classify(b'District,Year,Count\nSome District,2015-16,100\n') == SAVED
+    assert classify(b'<html><body>No Search Results</body></html>') == NO_RESULTS
+    assert classify(b'The query you have run did not contain any results.') == NO_RESULTS
+    assert classify(b'<HTML><head><title>SAS Logon</title></head>') == BAD_RESPONSE
+    assert classify(b'District,Year,Count\n', status=500) == BAD_RESPONSE
+
+
+def test_journal_resumes_missing_and_failed_targets(tmpdir):
+    from ctdata_edsight_scraping_tool.journal import Journal
+    targets = [{'url': 'http://edsight.ct.gov/do', 'param': {'_year': y}, 'filename': str(tmpdir.join(y + '.csv'))}
+               for y in ('2013-14', '2014-15', '2015-16', '2016-17')]
+    journal = Journal.for_directory(str(tmpdir))
+    for t in targets[:3]:
+        open(t['filename'], 'w').close()
+    journal.record(targets[0], {'status': 'saved', 'bytes': 0, 'checksum': 'abc'})
+    journal.record(targets[1], {'status': 'bad_response'})
+    journal.record(targets[2], {'status': 'saved'})
+    tmpdir.join('2015-16.csv').remove()
+    journal.close()
+
+    journal = Journal.for_directory(str(tmpdir))
+    assert journal.get(targets[0])['checksum'] == 'abc'
+    assert list(journal.pending(targets)) == targets[1:]
+
+
+def test_adaptive_limiter_grows_when_healthy_and_halves_on_trouble():
+    from ctdata_edsight_scraping_tool.limits import AdaptiveLimiter
+    changes = []
+    limiter = AdaptiveLimiter(floor=2, ceiling=6, initial=4, on_change=changes.append)
+    for _ in range(4):
+        limiter.record({'status': 'saved', 'attempts': 1, 'latency': .1})
+    assert limiter.limit == 5
+    for _ in range(20):
+        limiter.record({'status': 'saved', 'attempts': 1, 'latency': .1})
+    assert limiter.limit == 6
+    limiter.record({'status': 'bad_response', 'attempts': 4, 'latency': .1})
+    assert limiter.limit == 3
+    # Further failures within the same window do not back off again
+    limiter.record({'status': 'bad_response', 'attempts': 4, 'latency': .1})
+    assert limiter.limit == 3
+    for _ in range(30):
+        limiter.record({'status': 'network_error', 'attempts': 4})
+    assert limiter.limit == 2
+    assert changes == [5, 6, 3, 2]
+    assert [limit for _, limit in limiter.history] == [4, 5, 6, 3, 2]
+
+
+def test_adaptive_limiter_treats_slow_responses_as_congestion():
+    from ctdata_edsight_scraping_tool.limits import AdaptiveLimiter
+    limiter = AdaptiveLimiter(floor=1, ceiling=10, initial=8)
+    limiter.record({'status': 'saved', 'attempts': 1, 'latency': .1})
+    for _ in range(8):
+        limiter.record({'status': 'saved', 'attempts': 1, 'latency': 2.0})
+    assert limiter.limit == 4
+
+
+def test_token_bucket_reserves_slots_instead_of_spinning():
+    from ctdata_edsight_scraping_tool.ratelimit import TokenBucket
+    bucket = TokenBucket(10, burst=2)
+    delays = [bucket.take() for _ in range(4)]
+    assert delays[:2] == [0, 0]
+    assert abs(delays[2] - .1) < .02 and abs(delays[3] - .2) < .02
+
+
+def test_token_bucket_budget_is_shared_through_state_file(tmpdir):
+    from ctdata_edsight_scraping_tool.ratelimit import TokenBucket
+    path = str(tmpdir.join('ratelimit'))
+    # Two buckets on one file behave like two processes drawing from the same budget
+    first, second = TokenBucket(5, burst=1, path=path), TokenBucket(5, burst=1, path=path)
+    assert first.take() == 0
+    assert abs(second.take() - .2) < .02
+
+
+def test_token_bucket_falls_back_to_own_budget_when_state_file_is_not_writable(tmpdir, monkeypatch):
+    from ctdata_edsight_scraping_tool.defaults import SHARED_STATE_PATH
+    from ctdata_edsight_scraping_tool.ratelimit import TokenBucket
+    if hasattr(os, 'getuid'):
+        assert SHARED_STATE_PATH.endswith('-{}'.format(os.getuid()))
+
+    def refuse(path, *args):
+        raise PermissionError(13, 'Permission denied', path)
+    # As when the file in the shared temp directory belongs to another user
+    monkeypatch.setattr(os, 'open', refuse)
+    bucket = TokenBucket(5, burst=1, path=str(tmpdir.join('ratelimit')))
+    assert bucket.take() == 0
+    assert abs(bucket.take() - .2) < .02
+    assert bucket.path is None
+
+def test_download_targets_are_planned_lazily(dataset):
+    import types
+    from ctdata_edsight_scraping_tool.helpers import _iter_download_targets, _setup_download_targets
+    catalog = {'Chronic Absenteeism': dataset}
+    targets = _iter_download_targets('Chronic Absenteeism', './', 'District', catalog)
+    assert isinstance(targets, types.GeneratorType)
+    first = next(targets)
+    assert first['param']['_year'] == 'Trend'
+    assert [first] + list(targets) == _setup_download_targets('Chronic Absenteeism', './', 'District', catalog)
+
+
+def test_add_ct_dedupes_state_rows_in_first_seen_order():
+    from ctdata_edsight_scraping_tool.helpers import _add_ct
+    params = [
+        {'_year': '2015-16', '_district': 'Hartford', '_school': 'A'},
+        {'_year': '2015-16', '_district': 'Hartford', '_school': 'B'},
+        {'_year': '2014-15', '_district': 'Hartford', '_school': 'A'},
+        {'_district': 'Hartford', '_year': '2015-16'},
+    ]
+    assert _add_ct(params) == params + [
+        {'_year': '2015-16', '_district': 'State of Connecticut'},
+        {'_year': '2014-15', '_district': 'State of Connecticut'},
+    ]
+
+
+def test_memoized_slugs_match_slugging_whole_filenames_for_the_catalog(monkeypatch):
+    import json
+    from ctdata_edsight_scraping_tool import helpers
+    from ctdata_edsight_scraping_tool.cli import LINKS_PATH
+    from ctdata_edsight_scraping_tool.helpers import _slugify_filename, custom_slugify
+    with open(LINKS_PATH) as f:
+        catalog = json.load(f)
+
+    def plan_catalog():
+        names = []
+        for entry in helpers._build_catalog_geo_list(catalog):
+            for geo in entry['geos']:
+                try:
+                    targets = helpers._setup_download_targets(entry['dataset'], 'out', geo, catalog, 'gzip')
+                except KeyError:
+                    continue
+                names.extend(t['filename'] for t in targets)
+        return names
+
+    memoized = plan_catalog()
+    monkeypatch.setattr(helpers, '_slugify_filename', lambda parts: custom_slugify('_'.join(parts)))
+    assert len(memoized) > 6000
+    assert memoized == plan_catalog()
+    # Parts that only slug the same in context fall back to slugging the whole name
+    for parts in (['Bullying', '', ' 2015-16'], ['Bullying', '', '(K-12)', ''], ['U.S.', 'A.B.', '-'],
+                  ['Grads', '', 'All Students', '4-Year ']):
+        assert _slugify_filename(parts) == custom_slugify('_'.join(parts))
+
+def test_precompiled_catalog_is_invalidated_by_content(tmpdir):
+    import json
+    import os
+    from ctdata_edsight_scraping_tool.catalog import load_catalog
+    path = str(tmpdir.join('datasets.json'))
+    cache_dir = str(tmpdir.join('cache'))
+    with open(path, 'w') as f:
+        json.dump({'Bullying': {'filters': []}}, f)
+    assert load_catalog(path, cache_dir) == {'Bullying': {'filters': []}}
+    assert len(os.listdir(cache_dir)) == 1
+    assert load_catalog(path, cache_dir) == {'Bullying': {'filters': []}}
+
+    # Touching the file without changing it keeps the precompiled copy
+    os.utime(path, (0, 0))
+    assert load_catalog(path, cache_dir) == {'Bullying': {'filters': []}}
+
+    with open(path, 'w') as f:
+        json.dump({'Bullying': {'filters': []}, 'Incidents': {'filters': []}}, f)
+    os.utime(path, (0, 0))
+    assert sorted(load_catalog(path, cache_dir)) == ['Bullying', 'Incidents']
+
+
+class FakeS3Key(object):
+    """Stands in for a boto S3 key holding the remote catalog."""
+
+    def __init__(self, body):
+        import hashlib
+        self.body = body
+        self.etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+
+    def get_contents_to_file(self, fp):
+        for i in range(0, len(self.body), 7):
+            fp.write(self.body[i:i + 7])
+
+
+@pytest.fixture
+def local_catalog(tmpdir, monkeypatch):
+    from ctdata_edsight_scraping_tool import cli
+    monkeypatch.setattr(cli, 'LINKS_DIR', str(tmpdir))
+    monkeypatch.setattr(cli, 'LINKS_PATH', str(tmpdir.join('datasets.json')))
+    monkeypatch.setattr(cli, 'ETAG_PATH', str(tmpdir.join('datasets.json.etag')))
+    return tmpdir
+
+
+def test_catalog_update_streams_validates_and_records_etag(local_catalog):
+    import json
+    from ctdata_edsight_scraping_tool import cli
+    body = json.dumps({'Bullying': {'filters': [], 'download_link': 'http://edsight.ct.gov/do'}}).encode()
+    key = FakeS3Key(body)
+    cli._replace_local_catalog(key)
+    assert local_catalog.join('datasets.json').read_binary() == body
+    assert cli._local_etag() == key.etag.strip('"')
+
+    with pytest.raises(ValueError):
+        cli._replace_local_catalog(FakeS3Key(b'{"Bullying": {}}'))
+    assert local_catalog.join('datasets.json').read_binary() == body
+    assert sorted(p.basename for p in local_catalog.listdir()) == ['datasets.json', 'datasets.json.etag']
+
+
+def test_remote_catalog_lookup_is_conditional(local_catalog, monkeypatch):
+    import boto
+    from boto.exception import S3ResponseError
+    from ctdata_edsight_scraping_tool import cli
+    requests = []
+    present = True
+
+    class FakeBucket(object):
+        def get_key(self, name, headers=None):
+            requests.append(headers)
+            if headers and headers['If-None-Match'] == '"abc"':
+                raise S3ResponseError(304, 'Not Modified')
+            return FakeS3Key(b'{}') if present else None
+
+    class FakeConnection(object):
+        def get_bucket(self, name, validate=True):
+            assert not validate
+            return FakeBucket()
+
+    monkeypatch.setattr(boto, 'connect_s3', lambda: FakeConnection())
+    assert cli._get_remote_catalog_file('abc') is None
+    assert cli._get_remote_catalog_file('def') is not None
+    assert requests == [{'If-None-Match': '"abc"'}, {'If-None-Match': '"def"'}]
+
+    # A missing catalog is an error, not "already the latest version"
+    present = False
+    result = CliRunner().invoke(cli.main, ['update-catalog'])
+    assert result.exit_code == 1
+    assert 'There is no datasets.json' in result.output and 'latest version' not in result.output
+
+
+def test_plan_counts_done_targets_and_uses_journal_latency(dataset, tmpdir):
+    from ctdata_edsight_scraping_tool.helpers import _setup_download_targets
+    from ctdata_edsight_scraping_tool.journal import Journal
+    from ctdata_edsight_scraping_tool.plan import plan_dataset, open_journal, estimate_seconds, DEFAULT_LATENCY
+    catalog = {'Chronic Absenteeism': dataset}
+    targets = _setup_download_targets('Chronic Absenteeism', str(tmpdir), 'District', catalog)
+    assert open_journal(str(tmpdir)) is None
+    assert not tmpdir.listdir()
+
+    journal = Journal.for_directory(str(tmpdir))
+    for t in targets[:2]:
+        open(t['filename'], 'w').close()
+        journal.record(t, {'status': 'saved', 'elapsed': 3.0})
+    journal.record(targets[2], {'status': 'bad_response', 'elapsed': 1.0})
+    journal.close()
+
+    journal = open_journal(str(tmpdir))
+    [plan] = plan_dataset('Chronic Absenteeism', [(str(tmpdir), 'District')], catalog, journal)
+    assert (plan['targets'], plan['done'], plan['remaining']) == (len(targets), 2, len(targets) - 2)
+    fresh, school = plan_dataset('Chronic Absenteeism', [(str(tmpdir.mkdir('fresh')), 'District'),
+                                                         (str(tmpdir.mkdir('school')), 'School')], catalog)
+    # The state-level requests are shared with the District directory
+    assert (school['files'], school['targets']) == (len(targets), len(targets) / 2)
+    estimate_seconds([plan, fresh], concurrency=2)
+    assert plan['latency'] == fresh['latency'] == 7.0 / 3
+    assert estimate_seconds([fresh], concurrency=2) == len(targets) * DEFAULT_LATENCY / 2
+    assert estimate_seconds([fresh], concurrency=2, rate=.5) == len(targets) / .5
+
+
+def test_run_metrics_report_percentiles_by_dataset(tmpdir):
+    import json
+    from ctdata_edsight_scraping_tool.metrics import RunMetrics, percentile
+    assert percentile([], .5) is None
+    assert [percentile(range(1, 101), q) for q in (.5, .95, .99)] == [50, 95, 99]
+
+    metrics = RunMetrics()
+    metrics.add_job('Chronic Absenteeism', str(tmpdir.join('ca')), 'District')
+    for i in range(1, 21):
+        metrics.record({'filename': str(tmpdir.join('ca', '{}.csv'.format(i)))},
+                       {'status': 'saved', 'attempts': 1, 'latency': i / 10, 'ttfb': .05, 'bytes': 100, 'elapsed': .1})
+    metrics.record({'filename': str(tmpdir.join('other', 'x.csv'))}, {'status': 'network_error', 'attempts': 4})
+
+    metrics.write_json(str(tmpdir.join('run.json')))
+    report = json.load(tmpdir.join('run.json').open())
+    ca = report['datasets']['Chronic Absenteeism (District)']
+    assert (ca['requests'], ca['bytes'], ca['retries']) == (20, 2000, 0)
+    assert (ca['latency']['p50'], ca['latency']['p95'], ca['latency']['p99']) == (1.0, 1.9, 2.0)
+    assert report['datasets']['other']['outcomes']['network_error'] == 1
+    assert report['datasets']['other']['retries'] == 3
+
+    metrics.write_prometheus(str(tmpdir.join('run.prom')))
+    prom = tmpdir.join('run.prom').read().splitlines()
+    assert 'edsight_requests_total{dataset="Chronic Absenteeism (District)",outcome="saved"} 20' in prom
+    assert 'edsight_request_latency_seconds{dataset="Chronic Absenteeism (District)",quantile="0.95"} 1.9' in prom
+    assert '# TYPE edsight_time_to_first_byte_seconds summary' in prom
+
+
+def test_fetch_summary_keeps_jsonl_stdout_pure_and_reports_limit_history(tmpdir, capsys):
+    import json
+    from ctdata_edsight_scraping_tool.cli import _finish_run, _start_progress
+    from ctdata_edsight_scraping_tool.limits import AdaptiveLimiter
+    from ctdata_edsight_scraping_tool.metrics import RunMetrics
+    from ctdata_edsight_scraping_tool.store import Store
+
+    def planning():
+        raise AssertionError('planned before the first request')
+        yield
+
+    # Only the modes that show a total count the targets before fetching
+    assert _start_progress('quiet', planning(), None, False).total is None
+    bar = _start_progress('bar', iter([{}, {}]), None, False)
+    bar.close()
+    assert bar.total == 2
+    progress = _start_progress('jsonl', iter([]), None, False)
+    progress.close()
+    limiter = AdaptiveLimiter(initial=10)
+    limiter.history.append((12.0, 5))
+    metrics = RunMetrics()
+    _finish_run(progress, Store(str(tmpdir.join('store'))), limiter, metrics, str(tmpdir.join('run.json')),
+                str(tmpdir.join('run.prom')))
+    out, err = capsys.readouterr()
+    assert [json.loads(line)['event'] for line in out.splitlines()] == ['done']
+    assert 'Concurrency limit: 10, 5 after 12s' in err and 'Run report written' in err
+    report = json.load(tmpdir.join('run.json').open())
+    assert report['concurrency_limit'] == [{'seconds': 0.0, 'limit': 10}, {'seconds': 12.0, 'limit': 5}]
+    assert 'edsight_concurrency_limit 5' in tmpdir.join('run.prom').read().splitlines()
+
+
+def test_catalog_fetch_counts_the_shipped_catalog_and_skips_unplannable_datasets(tmpdir, capsys):
+    from ctdata_edsight_scraping_tool.catalog import load_catalog
+    from ctdata_edsight_scraping_tool.cli import LINKS_PATH, _catalog_jobs, _start_progress
+    from ctdata_edsight_scraping_tool.helpers import _setup_catalog_targets
+    from ctdata_edsight_scraping_tool.journal import Journal
+    links = load_catalog(LINKS_PATH)
+    jobs = _catalog_jobs(links, str(tmpdir))
+    # Educator Demographics has no _district filter to build its file names from
+    assert 'Educator Demographics (District): cannot be planned' in capsys.readouterr().err
+    assert 'Educator Demographics' not in [dataset for dataset, _, _ in jobs]
+    assert ('Bullying', str(tmpdir.join('bullying-district')), 'District') in jobs
+    assert not tmpdir.join('educator-demographics-district').exists()
+    journal = Journal.for_directory(str(tmpdir))
+    bar = _start_progress('bar', _setup_catalog_targets(jobs, links), journal, True)
+    bar.close()
+    journal.close()
+    assert bar.total > 1000
+
+def test_progress_counts_retries_and_reports_only_failures():
+    import io
+    import json
+    from ctdata_edsight_scraping_tool.progress import Progress
+    stream = io.StringIO()
+    progress = Progress(total=3, mode='jsonl', interval=60, stream=stream).start()
+    progress.retry('/data/a.csv', 'http://edsight.ct.gov/do?a', 1)
+    progress.retry('/data/b.csv', 'http://edsight.ct.gov/do?b', 1)
+    assert progress.status()['retrying'] == 2
+    progress.finished('/data/a.csv', 'http://edsight.ct.gov/do?a', {'status': 'saved', 'attempts': 2, 'bytes': 10})
+    progress.finished('/data/b.csv', 'http://edsight.ct.gov/do?b', {'status': 'bad_response', 'attempts': 4})
+    progress.finished('/data/c.csv', 'http://edsight.ct.gov/do?c', {'status': 'no_results', 'attempts': 1})
+    assert progress.status()['retrying'] == 0
+    progress.close()
+
+    events = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert [e['event'] for e in events] == ['failed', 'done']
+    assert (events[0]['file'], events[0]['status'], events[0]['attempts']) == ('/data/b.csv', 'bad_response', 4)
+    assert (events[1]['completed'], events[1]['total'], events[1]['failures'], events[1]['bytes']) == (3, 3, 1, 10)
+
+
+@pytest.mark.parametrize('fmt', ['parquet', 'feather'])
+def test_consolidate_streams_csvs_into_one_columnar_file(dataset, tmpdir, fmt):
+    pytest.importorskip('pyarrow')
+    from ctdata_edsight_scraping_tool.consolidate import consolidate, read
+    from ctdata_edsight_scraping_tool.helpers import _setup_download_targets
+    catalog = {'Chronic Absenteeism': dataset}
+    targets = _setup_download_targets('Chronic Absenteeism', str(tmpdir), 'District', catalog)
+    with open(targets[0]['filename'], 'w') as f:
+        f.write('District,Count\nAndover,12\nAvon,*\n')
+    with open(targets[-1]['filename'], 'w') as f:
+        f.write('District,Rate\nState of Connecticut,10.5\n')
+
+    path = str(tmpdir.join('chronic-absenteeism-district.' + fmt))
+    assert consolidate('Chronic Absenteeism', str(tmpdir), 'District', catalog, path, fmt) == (2, 3)
+    table = read(path)
+    assert table.column_names == ['District', 'Count', 'Rate', 'Year', 'District (filter)', 'School', 'Filter By']
+    rows = table.to_pylist()
+    assert rows[1] == {'District': 'Avon', 'Count': '*', 'Rate': None, 'Year': 'Trend', 'District (filter)': None,
+                       'School': None, 'Filter By': 'All Students'}
+    assert rows[2]['District (filter)'] == 'State of Connecticut'
+    assert rows[2]['Year'] == targets[-1]['param']['_year']
+
+
+def test_consolidate_reads_exports_as_text_streams(tmpdir):
+    pytest.importorskip('pyarrow')
+    import csv
+    import gzip
+    from ctdata_edsight_scraping_tool.consolidate import plan_columns
+    from ctdata_edsight_scraping_tool.output import open_text
+    body = '\ufeffDistrict,Count\r\nAndover,"1\r\n2"\r\n'.encode('utf-8') + 'Caf\xe9,3\r\n'.encode('cp1252')
+    files = {'a.csv': body, 'a.csv.gz': gzip.compress(body)}
+    try:
+        import zstandard
+        files['a.csv.zst'] = zstandard.ZstdCompressor().compress(body)
+    except ImportError:
+        pass
+    for name, data in files.items():
+        tmpdir.join(name).write_binary(data)
+        with open_text(str(tmpdir.join(name))) as f:
+            assert list(csv.reader(f)) == [['District', 'Count'], ['Andover', '1\r\n2'], ['Caf\xe9', '3']]
+    # The header pass reads one line, so a large file that is cut short further on is no obstacle
+    big = gzip.compress(b'District,Count\r\n' + b'Andover,1\r\n' * 100000)
+    tmpdir.join('big.csv.gz').write_binary(big[:len(big) // 2])
+    columns, present = plan_columns([{'filename': str(tmpdir.join('big.csv'))}])
+    assert columns == ['District', 'Count'] and present[0][1].endswith('big.csv.gz')
+    with pytest.raises(EOFError):
+        with open_text(str(tmpdir.join('big.csv.gz'))) as f:
+            f.read()
+
+
+def test_compressed_targets_stream_and_count_as_present(dataset, tmpdir):
+    import gzip
+    from ctdata_edsight_scraping_tool.helpers import _setup_download_targets
+    from ctdata_edsight_scraping_tool.journal import Journal
+    import importlib.util
+    from ctdata_edsight_scraping_tool.output import Body, open_text
+    catalog = {'Chronic Absenteeism': dataset}
+    plain = _setup_download_targets('Chronic Absenteeism', str(tmpdir), 'District', catalog)
+    packed = _setup_download_targets('Chronic Absenteeism', str(tmpdir), 'District', catalog, 'gzip')
+    assert [t['filename'] for t in packed] == [t['filename'] + '.gz' for t in plain]
+
+    csv = b'District,Count\n' + b'Andover,12\n' * 1000
+    outputs = []
+    for _ in range(2):
+        body = Body.for_file(packed[0]['filename'])
+        outputs.append(b''.join(body.feed(csv[i:i + 100]) for i in range(0, len(csv), 100)) + body.finish())
+    assert outputs[0] == outputs[1]
+    assert gzip.decompress(outputs[0]) == csv
+    assert (body.bytes, len(outputs[0]) < len(csv) / 10) == (len(csv), True)
+
+    with open(packed[0]['filename'], 'wb') as f:
+        f.write(outputs[0])
+    with open_text(packed[0]['filename']) as f:
+        assert f.read() == csv.decode()
+    if importlib.util.find_spec('zstandard') is not None:
+        name = str(tmpdir.join('andover.csv.zst'))
+        body = Body.for_file(name)
+        tmpdir.join('andover.csv.zst').write_binary(body.feed(csv) + body.finish())
+        with open_text(name) as f:
+            assert f.read() == csv.decode()
+    journal = Journal.for_directory(str(tmpdir))
+    assert journal.is_done(packed[0]) and journal.is_done(plain[0])
+    assert not journal.is_done(plain[1])
+
+
+def test_store_keeps_identical_bodies_once(tmpdir, monkeypatch):
+    import hashlib
+    import os
+    from ctdata_edsight_scraping_tool import output, store as store_module
+    from ctdata_edsight_scraping_tool.store import Store
+    store = Store.for_directory(str(tmpdir))
+    body = b'District,Count\nAndover,12\n'
+    checksum = hashlib.sha256(body).hexdigest()
+    names = [str(tmpdir.join(n)) for n in ('a.csv', 'b.csv', 'c.csv')]
+    for name in names[:2]:
+        tmpdir.join('body.part').write_binary(body)
+        store.put(str(tmpdir.join('body.part')), checksum, name)
+    assert (store.stored, store.deduplicated, store.bytes_saved) == (1, 1, len(body))
+    assert os.path.samefile(names[0], names[1])
+    assert os.path.samefile(names[0], store.path_for(checksum))
+    assert not tmpdir.join('body.part').exists()
+
+    def no_links(src, dst):
+        raise OSError('links not supported')
+    monkeypatch.setattr(store_module.os, 'link', no_links)
+    monkeypatch.setattr(output, '_reflink', no_links)
+    tmpdir.join('body.part').write_binary(body)
+    store.put(str(tmpdir.join('body.part')), checksum, names[2])
+    assert tmpdir.join('c.csv').read_binary() == body
+    assert not os.path.samefile(names[0], names[2])
+
+
+def test_saving_places_finished_bodies_and_discards_failed_ones(tmpdir):
+    from ctdata_edsight_scraping_tool.output import saving
+    from ctdata_edsight_scraping_tool.responses import SAVED, make_result
+    file, other = str(tmpdir.join('a_ct.csv')), str(tmpdir.join('school', 'a_ct.csv'))
+    tmpdir.mkdir('school')
+    with saving(file, also=[other]) as (part, body):
+        with open(part, 'wb') as f:
+            f.write(body.feed(b'District,Count\n') + body.finish())
+    assert tmpdir.join('a_ct.csv').read() == tmpdir.join('school', 'a_ct.csv').read() == 'District,Count\n'
+    result = make_result(SAVED, 2, 0.0, .1, .05, body)
+    assert (result['bytes'], result['checksum'], result['attempts']) == (15, body.checksum, 2)
+
+    with pytest.raises(ValueError):
+        with saving(str(tmpdir.join('b.csv'))) as (part, body):
+            with open(part, 'wb') as f:
+                f.write(b'District')
+            raise ValueError('connection lost')
+    assert sorted(p.basename for p in tmpdir.listdir()) == ['a_ct.csv', 'school']
+
+
+@pytest.mark.parametrize('hardlinks', [True, False])
+def test_store_stores_a_body_once_when_workers_race(tmpdir, monkeypatch, hardlinks):
+    import hashlib
+    import threading
+    from ctdata_edsight_scraping_tool import store as store_module
+    from ctdata_edsight_scraping_tool.store import Store
+    store = Store.for_directory(str(tmpdir))
+    body = b'District,Count\nAndover,12\n'
+    checksum = hashlib.sha256(body).hexdigest()
+    barrier = threading.Barrier(2, timeout=5)
+    makedirs = os.makedirs
+
+    def racing_makedirs(path, **kwargs):
+        makedirs(path, **kwargs)
+        # Both workers get as far as storing the object before either of them does
+        if path == os.path.dirname(store.path_for(checksum)):
+            barrier.wait()
+    monkeypatch.setattr(store_module.os, 'makedirs', racing_makedirs)
+    if not hardlinks:
+        def no_links(src, dst):
+            raise OSError('links not supported')
+        monkeypatch.setattr(store_module.os, 'link', no_links)
+
+    def put(name):
+        tmpdir.join(name + '.part').write_binary(body)
+        store.put(str(tmpdir.join(name + '.part')), checksum, str(tmpdir.join(name)))
+    workers = [threading.Thread(target=put, args=(n,)) for n in ('a.csv', 'b.csv')]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    assert (store.stored, store.deduplicated) == (1, 1)
+    assert tmpdir.join('a.csv').read_binary() == tmpdir.join('b.csv').read_binary() == body
+    assert os.listdir(os.path.dirname(store.path_for(checksum))) == [checksum]
+    if hardlinks:
+        assert os.path.samefile(str(tmpdir.join('a.csv')), str(tmpdir.join('b.csv')))
+
+
+@contextmanager
+def running_stub(**options):
+    """A StubServer serving from its own event loop on a background thread."""
+    import asyncio
+    import threading
+    from benchmarks.stub_server import StubServer
+    loop = asyncio.new_event_loop()
+    server = StubServer(**options)
+    loop.run_until_complete(server.start())
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    try:
+        yield server
+    finally:
+        asyncio.run_coroutine_threadsafe(server.stop(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+
+
+def test_fetchers_recover_from_injected_faults_against_stub_server(dataset, tmpdir):
+    pytest.importorskip('aiohttp')
+    import io
+    from ctdata_edsight_scraping_tool.fetch_sync import fetch_targets_sync
+    from ctdata_edsight_scraping_tool.helpers import _setup_download_targets
+    from ctdata_edsight_scraping_tool.metrics import RunMetrics
+    from ctdata_edsight_scraping_tool.progress import Progress
+    from ctdata_edsight_scraping_tool.retry import RetryPolicy
+    catalog = {'Chronic Absenteeism': dataset}
+    with running_stub(catalog=catalog, error_rate=.2, reset_rate=.1, seed=3) as server:
+        dataset['download_link'] = dataset['download_link'].replace('http://edsight.ct.gov', server.origin)
+        targets = _setup_download_targets('Chronic Absenteeism', str(tmpdir), 'District', catalog)[:20]
+        metrics = RunMetrics()
+        fetch_targets_sync(targets, base_url=server.base_url, metrics=metrics,
+                           retry_policy=RetryPolicy(max_attempts=10, base_delay=.001),
+                           progress=Progress(mode='quiet', stream=io.StringIO()).start())
+    report = metrics.report()
+    assert server.faults['error'] and server.faults['reset']
+    assert report['requests'] == 20
+    assert sum(d['outcomes']['saved'] for d in report['datasets'].values()) == 20
+    assert sum(d['retries'] for d in report['datasets'].values()) == sum(server.faults.values())
+    header = tmpdir.join(targets[0]['filename'].split('/')[-1]).readlines()[0]
+    assert header.startswith('District,District Code,')
+
+
+def test_threaded_fetcher_primes_a_session_per_worker_and_isolates_failures(dataset, tmpdir):
+    pytest.importorskip('aiohttp')
+    import io
+    from ctdata_edsight_scraping_tool.fetch_sync import fetch_targets_threaded
+    from ctdata_edsight_scraping_tool.helpers import _setup_download_targets
+    from ctdata_edsight_scraping_tool.metrics import RunMetrics
+    from ctdata_edsight_scraping_tool.progress import Progress
+    from ctdata_edsight_scraping_tool.retry import RetryPolicy
+    catalog = {'Chronic Absenteeism': dataset}
+    metrics = RunMetrics()
+    progress = Progress(mode='quiet', stream=io.StringIO()).start()
+    ahead = []
+
+    def planned(targets):
+        # How many targets had been handed out but not finished whenever another one was asked for
+        for i, t in enumerate(targets):
+            ahead.append(i - metrics.report()['requests'])
+            yield t
+
+    # Resets are retried without re-priming, so every prime is a worker thread's first request
+    with running_stub(catalog=catalog, reset_rate=.1, seed=5) as server:
+        dataset['download_link'] = dataset['download_link'].replace('http://edsight.ct.gov', server.origin)
+        targets = _setup_download_targets('Chronic Absenteeism', str(tmpdir), 'District', catalog)[:40]
+        # A target that cannot be written must not take the others down with it
+        targets[7] = dict(targets[7], filename=str(tmpdir.join('missing', 'broken.csv')))
+        fetch_targets_threaded(planned(targets), base_url=server.base_url, threads=3, metrics=metrics,
+                               progress=progress, retry_policy=RetryPolicy(max_attempts=10, base_delay=.001))
+    assert server.faults['reset']
+    assert 1 <= server.primes <= 3
+    assert max(ahead) <= 3 * 2 + 1
+    assert metrics.report()['requests'] == 39
+    assert progress.failures == 1 and 'broken.csv' in progress.stream.getvalue()
+    assert len(tmpdir.listdir(lambda p: p.ext == '.csv')) == 39
+
+
+def test_cli_and_threaded_fetcher_import_without_aiohttp_or_selenium():
+    import subprocess
+    import sys
+    script = ("import sys\n"
+              "for name in ('aiohttp', 'aiofiles', 'selenium'):\n"
+              "    sys.modules[name] = None\n"
+              "from ctdata_edsight_scraping_tool import cli\n"
+              "from ctdata_edsight_scraping_tool.fetch_sync import fetch_targets_threaded\n"
+              "from click.testing import CliRunner\n"
+              "assert CliRunner().invoke(cli.main, ['fetch', '--help']).exit_code == 0\n")
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    subprocess.check_call([sys.executable, '-c', script], cwd=root)
+
+
+@pytest.mark.parametrize('mode, timeout', [('sync', {'timeout': (1, .2)}), ('async', {'read_timeout': .2}),
+                                           ('async', {'total_timeout': .2})])
+def test_stalled_responses_time_out_and_are_retried(tmpdir, mode, timeout):
+    pytest.importorskip('aiohttp')
+    import asyncio
+    import io
+    from ctdata_edsight_scraping_tool.journal import Journal
+    from ctdata_edsight_scraping_tool.metrics import RunMetrics
+    from ctdata_edsight_scraping_tool.progress import Progress
+    from ctdata_edsight_scraping_tool.responses import NETWORK_ERROR
+    from ctdata_edsight_scraping_tool.retry import RetryPolicy
+    metrics = RunMetrics()
+    journal = Journal.for_directory(str(tmpdir))
+    options = dict(metrics=metrics, journal=journal, retry_policy=RetryPolicy(max_attempts=2, base_delay=.001),
+                   progress=Progress(mode='quiet', stream=io.StringIO()).start())
+    with running_stub(latency=.5) as server:
+        target = {'url': server.export_url, 'param': {'_district': 'Andover'},
+                  'filename': str(tmpdir.join('andover.csv'))}
+        if mode == 'sync':
+            from ctdata_edsight_scraping_tool.fetch_sync import fetch_targets_sync
+            fetch_targets_sync([target], base_url=server.base_url, **timeout, **options)
+        else:
+            from ctdata_edsight_scraping_tool.fetch_async import fetch_targets
+            loop = asyncio.new_event_loop()
+            loop.run_until_complete(fetch_targets([target], base_url=server.base_url, **timeout, **options))
+            loop.close()
+    assert server.requests - server.primes == 2
+    report = metrics.report()
+    assert report['requests'] == 1
+    assert [d['outcomes'][NETWORK_ERROR] for d in report['datasets'].values()] == [1]
+    assert journal.get(target)['status'] == NETWORK_ERROR and journal.get(target)['attempts'] == 2
+    assert not tmpdir.join('andover.csv').exists()
+
+
+
+def test_async_fetch_stops_its_workers_when_planning_fails(tmpdir):
+    pytest.importorskip('aiohttp')
+    import asyncio
+    import io
+    from ctdata_edsight_scraping_tool.fetch_async import fetch_targets
+    from ctdata_edsight_scraping_tool.progress import Progress
+
+    def planned():
+        for n in range(5):
+            yield {'url': server.export_url, 'param': {'_district': 'District {}'.format(n)},
+                   'filename': str(tmpdir.join('{}.csv'.format(n)))}
+        raise KeyError('_district')
+
+    loop = asyncio.new_event_loop()
+    with running_stub(latency=.2) as server:
+        with pytest.raises(KeyError):
+            loop.run_until_complete(fetch_targets(planned(), base_url=server.base_url,
+                                                  progress=Progress(mode='quiet', stream=io.StringIO()).start()))
+    assert not [t for t in asyncio.all_tasks(loop) if not t.done()]
+    loop.close()
+    assert not tmpdir.listdir(lambda p: p.ext == '.part')
+
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+
+class FakeBrowser(object):
+    """Stands in for a WebDriver over static EdSight pages, answering only what links_prep asks."""
+
+    def __init__(self, pages):
+        from bs4 import BeautifulSoup
+        self.pages = {url: BeautifulSoup(html, 'html.parser') for url, html in pages.items()}
+        self.url = None
+        self.visited = []
+        self.scripts = 0
+        self.clicked = []
+        self.quit_called = False
+
+    def get(self, url):
+        self.url = url
+        self.visited.append(url)
+
+    def find_element(self, by, xpath):
+        import re
+        from urllib.parse import urljoin
+        tag, text = re.match(r'//(\w+)\[contains\(text\(\), "(.+)"\)\]', xpath).groups()
+        element = self.pages[self.url].find(tag, string=lambda s: s and text in s)
+        browser = self
+
+        class Element(object):
+            def get_attribute(self, name):
+                return urljoin(browser.url, element[name])
+
+            def click(self):
+                browser.clicked.append(element.get_text())
+        return Element()
+
+    def execute_script(self, script, name):
+        from ctdata_edsight_scraping_tool.links_prep import OPTIONS_SCRIPT
+        assert script == OPTIONS_SCRIPT
+        self.scripts += 1
+        select = self.pages[self.url].find(attrs={'name': name})
+        text = lambda o: ' '.join(o.get_text().split())
+        return [[o.get('value', text(o)), text(o)] for o in select.find_all('option')]
+
+    def quit(self):
+        self.quit_called = True
+
+
+def test_rebuild_spreads_datasets_over_browser_workers_and_reads_each_select_once(tmpdir):
+    from ctdata_edsight_scraping_tool import links_prep
+    links, pages = {}, {}
+    for name, fixture, filters in [('Bullying', 'edsight_bullying.html', ['_year', '_district', '_school']),
+                                   ('Suspension Rates', 'edsight_suspension_rates.html',
+                                    ['_year', '_district', '_school', '_subgroup'])]:
+        link = 'http://edsight.ct.gov/SASStoredProcess/do?report={}'.format(fixture)
+        with open(os.path.join(FIXTURES, fixture)) as f:
+            pages[link] = f.read()
+        links[name] = {'dataset': name, 'link': link, 'download_link': None, 'filters': [
+            {'name': x, 'xpath_id': x, 'options': []} for x in filters]}
+    browsers = []
+
+    def make_browser():
+        browsers.append(FakeBrowser(pages))
+        return browsers[-1]
+    scraped = links_prep.build_links_object_json(links, workers=2, make_browser=make_browser)
+
+    assert list(scraped) == ['Bullying', 'Suspension Rates']
+    assert [f['options'] for f in scraped['Bullying']['filters']] == [
+        ['2016-17', '2015-16'],
+        ['State of Connecticut', 'All Districts', 'Andover School District', 'Ansonia School District'],
+        ['All Schools']]
+    assert scraped['Suspension Rates']['filters'][3]['options'] == [' ', 'ELL ', 'Gender ']
+    assert scraped['Bullying']['download_link'] == ('http://edsight.ct.gov/SASStoredProcess/do?_program=/CTDOE/'
+                                                    'EdSight/Release/Reporting/Public/Reports/StoredProcesses/'
+                                                    '/BullyingExport&_year=2016-17&_district=All+Districts&_school=+')
+    assert 1 <= len(browsers) <= 2 and all(b.quit_called for b in browsers)
+    assert all(b.visited[0] == links_prep.HOME_URL for b in browsers)
+    assert sum(b.scripts for b in browsers) == 7
+    assert sum(len(b.clicked) for b in browsers) == 2
+
+
+def test_http_rebuild_parses_saved_pages_like_the_browser_backend(tmpdir):
+    import json
+    import threading
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+    from urllib.parse import urlparse, parse_qs
+    from ctdata_edsight_scraping_tool import links_prep
+    requested = []
+
+    class SavedPages(BaseHTTPRequestHandler):
+        def do_GET(self):
+            requested.append(self.path)
+            qs = parse_qs(urlparse(self.path).query)
+            body = b'<html></html>'
+            if 'report' in qs:
+                names = ['edsight_{}.html'.format(qs['report'][0])]
+                if qs.get('_district') == ['All Districts']:
+                    names.insert(0, 'edsight_{}_all_districts.html'.format(qs['report'][0]))
+                path = next(p for p in (os.path.join(FIXTURES, n) for n in names) if os.path.exists(p))
+                with open(path, 'rb') as f:
+                    body = f.read()
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), SavedPages)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    origin = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    links = {
+        'Bullying': {'dataset': 'Bullying', 'link': origin + '/SASStoredProcess/do?report=bullying&_district=All+Districts',
+                     'filters': [{'name': 'Year', 'xpath_id': '_year'}, {'name': 'District', 'xpath_id': '_district'},
+                                 {'name': 'School', 'xpath_id': '_school'}]},
+        'Suspension Rates': {'dataset': 'Suspension Rates',
+                             'link': origin + '/SASStoredProcess/do?report=suspension_rates&_district=Andover',
+                             'filters': [{'name': 'School', 'xpath_id': '_school'},
+                                         {'name': 'Subgroup', 'xpath_id': '_subgroup'}]},
+    }
+    outfile = str(tmpdir.join('datasets.json'))
+    try:
+        links_prep.rebuild(links, outfile, workers=2, backend='http', base_url=origin + '/SASPortal/main.do')
+    finally:
+        server.shutdown()
+    with open(outfile) as f:
+        scraped = json.load(f)
+
+    assert tmpdir.listdir() == [tmpdir.join('datasets.json')]
+    assert list(scraped) == ['Bullying', 'Suspension Rates']
+    with open(os.path.join(FIXTURES, 'edsight_bullying.html')) as f:
+        browser = FakeBrowser({links['Bullying']['link']: f.read()})
+    assert scraped['Bullying'] == links_prep.scrape_dataset(browser, links['Bullying'])
+    assert scraped['Bullying']['download_link'].startswith(origin + '/SASStoredProcess/do?_program=/CTDOE/')
+    # Schools come from the All Districts page, everything else from the report page itself
+    assert [f['options'] for f in scraped['Suspension Rates']['filters']] == [
+        ['All Schools', 'Andover Elementary School', 'Ansonia High School'], [' ', 'ELL ', 'Gender ']]
+    pages = [p for p in requested if 'report=' in p]
+    assert len(pages) == 3 and sum(1 for p in requested if p == '/SASPortal/main.do') <= 2
+
+
+def test_http_rebuild_requests_have_a_timeout():
+    from ctdata_edsight_scraping_tool.links_prep import scrape_dataset_http
+    from ctdata_edsight_scraping_tool.session import TIMEOUT
+    with open(os.path.join(FIXTURES, 'edsight_bullying.html')) as f:
+        page = f.read()
+    timeouts = []
+
+    class FakeSession(object):
+        def get(self, url, timeout=None):
+            timeouts.append(timeout)
+            return type('Response', (object,), {'text': page, 'raise_for_status': lambda self: None})()
+
+    dataset = {'dataset': 'Bullying', 'link': 'http://edsight.ct.gov/SASStoredProcess/do?report=bullying',
+               'filters': [{'name': 'Year', 'xpath_id': '_year'}]}
+    assert scrape_dataset_http(FakeSession(), dataset)['filters'][0]['options']
+    assert timeouts == [TIMEOUT]